@@ -0,0 +1,78 @@
+'''
+Runs a saved Form2Email configuration without the gui.
+
+    python Daemon.py settings.txt
+
+The save file is the one written by File > Save in the gui. Its sheets are
+loaded and its TimeInterval, Keyword and Response# groups are run in a
+plain loop until the process gets SIGINT or SIGTERM, so it can be run on a
+server under a process supervisor. Neither tkinter nor PIL is imported.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import signal
+import argparse
+import threading
+
+import matplotlib
+# charts are only saved to files, never shown
+matplotlib.use('Agg')
+
+import Engine
+
+
+class Form2EmailDaemon(Engine.Engine):
+    '''Headless counterpart of Gui.Form2Email'''
+
+    def __init__(self, savefile):
+        # the engine changes into the image directory
+        self.savefile = os.path.abspath(savefile)
+        Engine.Engine.__init__(self)
+        self.stopped = threading.Event()
+
+    def start(self):
+        '''Loads the save file, fetches every sheet and starts the groups.
+        Sheets cached by an earlier run only have their new rows fetched.
+        Returns False if the configuration could not be started.'''
+        self.sheet_entries, groups = self.read_save_file(self.savefile)
+        self.sheet_data = self.get_data(self.sheet_entries)
+        return self.start_groups(groups)
+
+    def serve(self):
+        '''Polls until stop is called or a group reports an error'''
+        while self.running and not self.stopped.is_set():
+            delay = self.poll()
+            self.stopped.wait(delay)
+        self.sheets_client.executor.shutdown(wait=False)
+        # keep what the last checks queued; the outbox sends it next run
+        self.send_pending(send=False)
+        self.send_queue.stop()
+        self.transport.shutdown()
+        self.outbox.close()
+
+    def stop(self, *args):
+        print('Stopping Form2Email...')
+        self.running = False
+        self.stopped.set()
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        description='Run a saved Form2Email configuration without the gui.')
+    argparser.add_argument('savefile', help='file written by File > Save')
+    args, unknown = argparser.parse_known_args(argv)
+
+    daemon = Form2EmailDaemon(args.savefile)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    if not daemon.start():
+        return 1
+    print('Form2Email is currently Running')
+    daemon.serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,973 @@
+from __future__ import print_function
+import time
+import os
+import gc
+import re
+import hashlib
+import collections
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import datetime
+from datetime import timedelta
+from dateutil import parser
+
+import GSheet
+import GMail
+import GDrive
+import FakeGoogle
+import Scheduler
+import SendQueue
+import Outbox
+import RateLimit
+import Snapshot
+import Template
+import Transport
+
+
+class Engine:
+    '''Everything Form2Email needs to watch sheets and send emails that does
+    not involve the gui: the sheet data, the three email sending options,
+    the email template commands and the poll loop. The gui (Gui.Form2Email)
+    and the headless daemon (Daemon.Form2EmailDaemon) are built on top.'''
+
+    class TimeInterval:
+        '''One of three classes for the email sending options. This class is responsible
+        for sending an email according to a time interval set by the user'''
+
+        # set by start_groups; names the saved state and delivery keys
+        name = None
+
+        def __init__(self, cls, group_n, time, interval, email_addresses, subject_entry,
+                     html_entry, d):
+
+            self.cls = cls
+            self.group_number = group_n
+
+            # error checking for user input
+            try:
+                self.time = parser.parse(time)
+            except BaseException:
+                self.cls.create_error(
+                    "Could Not Parse Time for TimeInterval in Group" + str(self.group_number))
+
+            # error checking for user input
+            try:
+                self.regex = re.compile(
+                    r'((?P<days>\d+?)d)?((?P<hours>\d+?)hr)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?')
+            except BaseException:
+                self.cls.create_error(
+                    "Could Not Parse Interval for TimeInterval in Group" + str(self.group_number))
+
+            self.interval = self.get_timedelta(interval)
+            if not self.interval:
+                self.cls.create_error(
+                    "Could Not Parse Interval for TimeInterval in Group" + str(self.group_number))
+            self.email_addresses = email_addresses
+            self.subject = subject_entry
+            self.htmlbody = html_entry
+            self.template = cls.compile_template(html_entry)
+            self.data = d
+
+            print('TimeInterval Initiated...')
+            print('Email will be sent at ', self.time, 'with a ', self.interval,
+                  'delay')
+
+        def check(self, cls, d):
+            '''Checks to see if email sending conditions are met. If they are,
+            it sends an email'''
+            # takes the difference of the time of the next email and current
+            # time
+            time_difference = self.time - datetime.datetime.now()
+            print('TimeInterval: Time until next email: ',
+                  timedelta.total_seconds(time_difference))
+            # if that time difference is less than zero meaning that the time has
+            # passed, the program will send an email
+            if timedelta.total_seconds(time_difference) < 0:
+                print('Time is up. Sending Email...')
+                # times missed while the program was stopped are skipped, so
+                # one email is sent for the latest of them and the next is in
+                # the future
+                missed = -time_difference // self.interval
+                slot = self.time + missed * self.interval
+                # adds the time interval to the time when the email was supposed
+                # to be sent
+                self.time = slot + self.interval
+                self.data = d
+                self.send_email(cls, cls.delivery_key(self, slot.isoformat()))
+
+        def state(self):
+            return {'time': self.time.isoformat()}
+
+        def restore(self, state):
+            self.time = parser.parse(state['time'])
+
+        def sheets(self):
+            # every sheet is fetched when the email is due
+            return set()
+
+        def seconds_left(self):
+            '''Seconds until the next email is due'''
+            return timedelta.total_seconds(
+                self.time - datetime.datetime.now())
+
+        def get_timedelta(self, time_str):
+            '''Creates a timedelta from a time interval'''
+            parts = self.regex.match(time_str)
+            if not parts:
+                return
+            parts = parts.groupdict()
+            time_params = {}
+            for (name, param) in parts.items():
+                if param:
+                    time_params[name] = int(param)
+            return timedelta(**time_params)
+
+        def send_email(self, cls, key=None):
+            '''Sends Email'''
+            html, attach = cls.render(self.template, self.data, self.time)
+            cls.queue_email(self.email_addresses, self.subject, html, attach,
+                            key)
+
+    class Keyword:
+        '''One of three classes for the email sending options. This class is responsible
+        for sending an email according to a keyword in set by the user'''
+
+        name = None
+
+        def __init__(self, cls, group_n, sheet_identifier, keyword, email_addresses,
+                     subject_entry, html_entry, d):
+
+            self.cls = cls
+            self.group_number = group_n
+            self.sheet_number, self.special_column = self.identify(
+                sheet_identifier)
+            self.keyword = keyword
+            self.email_addresses = email_addresses
+            self.subject = subject_entry
+            self.htmlbody = html_entry
+            self.template = cls.compile_template(html_entry)
+            self.data = d
+            self.old_rows = len(self.data[self.sheet_number])
+            print('Keyword Initiated...')
+            print(
+                'Email will be sent when ',
+                self.keyword,
+                'is seen in ',
+                self.special_column,
+                'of Sheet',
+                self.sheet_number)
+
+        def identify(self, identifier):
+            '''Takes the sheet identifier from the user, and splits it into
+            sheet number and column'''
+            for x in range(0, len(identifier)):
+                if identifier[x] == '\\':
+                    if identifier[x + 1:].isdigit():
+                        return int(identifier[:x]) - 1, identifier[x + 1:]
+                    return int(
+                        identifier[:x]) - 1, self.cls.column_id_to_int(identifier[x + 1:])
+            # if there is no \, it returns an error
+            self.cls.create_error(
+                "Incorrect Sheet Identifier for Keyword in Group" + str(self.group_number))
+
+        def check(self, cls, d):
+            '''Checks to see if email sending conditions are met. If they are,
+            it sends an email'''
+            self.data = d
+            self.new_rows = len(self.data[self.sheet_number])
+            # checks to see if there is a new row
+            if self.new_rows > self.old_rows:
+                print('Keyword: New Row Found. Testing Keyword...')
+                # if keyword matches specific column on specific sheet, send
+                # email
+                sheet = self.data[self.sheet_number]
+                if sheet.cell(len(sheet) - 1,
+                              int(self.special_column) - 1) == self.keyword:
+                    print('Keyword Match! Sending Email...')
+                    self.old_rows = self.new_rows
+                    self.send_email(cls, cls.delivery_key(
+                        self, cls.row_key(sheet, -1)))
+                else:
+                    print('Keyword Mismatch')
+
+        def sheets(self):
+            '''Indexes of the sheets to poll: the watched sheet and every
+            sheet the email reads'''
+            return {self.sheet_number} | self.template.sheets()
+
+        def state(self):
+            return {'old_rows': self.old_rows}
+
+        def restore(self, state):
+            # rows may have been deleted while the program was stopped
+            self.old_rows = min(state['old_rows'],
+                                len(self.data[self.sheet_number]))
+
+        def send_email(self, cls, key=None):
+            html, attach = cls.render(self.template, self.data)
+            cls.queue_email(self.email_addresses, self.subject, html, attach,
+                            key)
+
+    class Response:
+
+        name = None
+
+        def __init__(self, cls, group_n, sheet_number, interval, email_addresses,
+                     subject_entry, html_entry, d):
+            self.cls = cls
+            self.group_number = group_n
+            try:
+                self.sheet_number = int(sheet_number) - 1
+            except BaseException:
+                self.cls.create_error(
+                    "Incorrect SheetNumber for Response# in Group" + str(self.group_number))
+            try:
+                self.interval = int(interval)
+            except BaseException:
+                self.cls.create_error(
+                    "Incorrect interval for Response# in Group" + str(self.group_number))
+            self.email_addresses = email_addresses
+            self.subject = subject_entry
+            self.htmlbody = html_entry
+            self.template = cls.compile_template(html_entry)
+            self.data = d
+            self.old_rows = len(self.data[self.sheet_number])
+            print('Response# Initiated...')
+            print(
+                'Email will be sent for every ',
+                self.interval,
+                'responses on Sheet',
+                self.sheet_number)
+
+        def check(self, cls, d):
+            self.data = d
+            self.new_rows = len(self.data[self.sheet_number])
+            if self.new_rows > self.old_rows:
+                print('Response: New Row Found. Testing Interval...')
+                if self.interval % self.new_rows == 0:
+                    print('Interval satisfied. Sending Email...')
+                    self.old_rows = self.new_rows
+                    self.send_email(cls, cls.delivery_key(
+                        self, cls.row_key(self.data[self.sheet_number], -1)))
+
+        def sheets(self):
+            return {self.sheet_number} | self.template.sheets()
+
+        def state(self):
+            return {'old_rows': self.old_rows}
+
+        def restore(self, state):
+            self.old_rows = min(state['old_rows'],
+                                len(self.data[self.sheet_number]))
+
+        def send_email(self, cls, key=None):
+            html, attach = cls.render(self.template, self.data)
+            cls.queue_email(self.email_addresses, self.subject, html, attach,
+                            key)
+
+    class MailMerge(Keyword):
+        '''One email per row. The recipient is read from a column of the
+        row, given like the Keyword sheet identifier (sheet\\column), and
+        variables in the subject and html without a row are filled from the
+        same row. Rows is a row range such as 2:50 or 10: that is sent as
+        rows arrive, or blank to send for every new row.'''
+
+        def __init__(self, cls, group_n, sheet_identifier, rows,
+                     subject_entry, html_entry, d):
+            self.cls = cls
+            self.group_number = group_n
+            self.sheet_number, self.special_column = self.identify(
+                sheet_identifier)
+            self.subject = cls.compile_template(subject_entry, plain=True)
+            self.htmlbody = cls.compile_template(html_entry)
+            self.data = d
+            try:
+                if rows.strip() == '':
+                    self.next_row = len(self.data[self.sheet_number])
+                    self.last_row = None
+                else:
+                    first, sep, last = rows.partition(':')
+                    self.next_row = max(int(first) - 1, 1)
+                    if sep and last.strip() == '':
+                        self.last_row = None
+                    else:
+                        self.last_row = int(last if sep else first)
+            except ValueError:
+                self.cls.create_error(
+                    "Incorrect rows for MailMerge in Group" +
+                    str(self.group_number))
+            print('MailMerge Initiated...')
+            print('Emails will be sent to the addresses in column',
+                  self.special_column, 'of Sheet', self.sheet_number)
+
+        def check(self, cls, d):
+            self.data = d
+            stop = len(self.data[self.sheet_number])
+            if self.last_row is not None:
+                stop = min(stop, self.last_row)
+            if stop > self.next_row:
+                print('MailMerge: Sending', stop - self.next_row, 'emails...')
+                self.send_email(cls, range(self.next_row, stop))
+                self.next_row = stop
+
+        def sheets(self):
+            return ({self.sheet_number} | self.subject.sheets() |
+                    self.htmlbody.sheets())
+
+        def state(self):
+            return {'next_row': self.next_row}
+
+        def restore(self, state):
+            # rows may have been deleted while the program was stopped; rows
+            # that were already sent keep their keys and are not sent again
+            self.next_row = min(state['next_row'],
+                                len(self.data[self.sheet_number]))
+
+        def send_email(self, cls, rows):
+            '''Queues one email for each row index in rows'''
+            sheet = self.data[self.sheet_number]
+            rows = list(rows)
+            bodies = self.htmlbody.renderRows(self.data, self.sheet_number,
+                                              rows)
+            subjects = self.subject.renderRows(self.data, self.sheet_number,
+                                               rows)
+            for x in range(0, len(rows)):
+                try:
+                    address = sheet.cell(rows[x],
+                                         int(self.special_column) - 1).strip()
+                except IndexError:
+                    address = ''
+                if '@' not in address or '.' not in address:
+                    print('MailMerge: no email address in row', rows[x] + 1)
+                    continue
+                html, attach = bodies[x]
+                cls.queue_email(address, subjects[x][0], html, attach,
+                                cls.delivery_key(
+                                    self, cls.row_key(sheet, rows[x])))
+
+    def __init__(self):
+        # (GSheet url, sheet title) of every configured sheet
+        self.sheet_entries = []
+        self.sheet_data = []
+        self.running_groups = []
+        self.running = True
+        # emails rendered during this poll, stored in the outbox at its end,
+        # with their delivery keys
+        self.outgoing = []
+        self.outgoing_keys = []
+        # trigger states as last saved in the outbox
+        self.saved_states = {}
+        # compiled email templates by their html and whether they are plain
+        self.templates = {}
+        # finished renders of the sheet versions in render_versions, by
+        # (template, time)
+        self.renders = {}
+        self.render_versions = None
+        self.render_hits = 0
+        self.render_misses = 0
+        # Snapshot.RunningCounts of the \\stat ranges that run to the last
+        # row, by (sheet number, column, first row)
+        self.aggregates = {}
+        # Snapshot.TimestampIndex of each sheet by sheet number
+        self.timestamps = {}
+        self.backend = FakeGoogle.fromEnvironment()
+        self.drive_client = GDrive.DriveClient(backend=self.backend)
+        self.mailer = GMail.GmailSender(backend=self.backend)
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        self.outbox = Outbox.Outbox(os.path.join(home_dir, '.outbox.db'))
+        self.transport = Transport.fromEnvironment(self.mailer)
+        self.send_queue = SendQueue.SendQueue(self.transport, self.outbox)
+        self.sheets_client = GSheet.SheetsClient(
+            incremental=True, drive=self.drive_client, backend=self.backend,
+            cache_dir=os.path.join(home_dir, '.cache'))
+        self.check_dirs()
+        gc.enable()
+
+    def read_save_file(self, filename):
+        '''Reads a file written by save_internal. Returns a list of
+        (GSheet url, sheet title) pairs and a list of groups, each a dict
+        with the emails, subject, method, entry, entry2 and html of the
+        group.'''
+        sheets = []
+        groups = []
+        openfile = open(filename, 'r')
+        line = openfile.readline()
+        while line:
+            line = openfile.readline()
+            while line == 'Sheet\n' or line == 'Group\n':
+                if line == 'Sheet\n':
+                    print('Loading Sheet...')
+                    url = openfile.readline()[:-1]
+                    title = openfile.readline()[:-1]
+                    sheets += [(url, title)]
+                    line = openfile.readline()
+                    continue
+                print('Loading Group...')
+                group = {}
+                for key in ('emails', 'subject', 'method', 'entry', 'entry2'):
+                    line = openfile.readline()
+                    group[key] = line[:len(line) - 1]
+                html = ''
+                while True:
+                    line = openfile.readline()
+                    if line == 'Sheet\n' or line == 'Group\n' or line == '':
+                        break
+                    html += line[:len(line) - 1]
+                group['html'] = html
+                groups += [group]
+        openfile.close()
+        print('File Loaded')
+        return sheets, groups
+
+    def start_groups(self, groups):
+        '''Creates the running groups from a list of group dicts as returned
+        by read_save_file and starts scheduling their sheets. Returns False
+        if a group could not be started.'''
+        self.running_groups = []
+        self.aggregates = {}
+        self.timestamps = {}
+        self.running = True
+
+        for i in range(0, len(groups)):
+            group = groups[i]
+            # mail merge reads its addresses from the sheet
+            if group['method'] != 'MailMerge' and not self.validate_emails(
+                    group['emails'], 'Group' + str(i + 1)):
+                return False
+            if group['method'] == 'TimeInterval':
+                if group['entry'] is None or group['entry'] == "":
+                    self.create_error(
+                        "Time is empty for TimeInterval in Group" + str(i + 1))
+                    return False
+                if group['entry2'] is None or group['entry2'] == "":
+                    self.create_error(
+                        "Interval is empty for TimeInterval in Group" + str(i + 1))
+                    return False
+                self.running_groups += [self.TimeInterval(
+                    self, i, group['entry'], group['entry2'], group['emails'],
+                    group['subject'], group['html'], self.sheet_data)]
+            elif group['method'] == 'Keyword':
+                if group['entry'] is None or group['entry'] == "":
+                    self.create_error(
+                        "SheetIdentifier is empty for Keyword in Group" + str(i + 1))
+                    return False
+                if group['entry2'] is None or group['entry2'] == "":
+                    self.create_error(
+                        "Keyword is empty for Keyword in Group" + str(i + 1))
+                    return False
+                self.running_groups += [self.Keyword(
+                    self, i, group['entry'], group['entry2'], group['emails'],
+                    group['subject'], group['html'], self.sheet_data)]
+            elif group['method'] == 'Response#':
+                if group['entry'] is None or group['entry'] == "":
+                    self.create_error(
+                        "SheetNumber is empty for Response# in Group" + str(i + 1))
+                    return False
+                if group['entry2'] is None or group['entry2'] == "":
+                    self.create_error(
+                        "Interval is empty for Response# in Group" + str(i + 1))
+                    return False
+                self.running_groups += [self.Response(
+                    self, i, group['entry'], group['entry2'], group['emails'],
+                    group['subject'], group['html'], self.sheet_data)]
+            elif group['method'] == 'MailMerge':
+                if group['entry'] is None or group['entry'] == "":
+                    self.create_error(
+                        "SheetIdentifier is empty for MailMerge in Group" + str(i + 1))
+                    return False
+                self.running_groups += [self.MailMerge(
+                    self, i, group['entry'], group['entry2'], group['subject'],
+                    group['html'], self.sheet_data)]
+            else:
+                self.create_error("Group" + str(i + 1) +
+                                  " does not have a send method")
+                return False
+
+        # a trigger carries on from its saved state as long as its group is
+        # configured the same way
+        for i in range(0, len(groups)):
+            trigger = self.running_groups[i]
+            trigger.name = '|'.join([str(i + 1), groups[i]['method'],
+                                     groups[i]['entry'],
+                                     groups[i]['entry2']])
+            state = self.outbox.state(trigger.name)
+            if state is not None:
+                print('Group' + str(i + 1), 'resuming from', state)
+                trigger.restore(state)
+                self.saved_states[trigger.name] = state
+
+        # sheets read by the emails are polled too, so they are not sent
+        # with the data fetched at start
+        self.scheduler = Scheduler.PollScheduler()
+        for x in self.running_groups:
+            for sheet in sorted(x.sheets()):
+                if 0 <= sheet < len(self.sheet_entries):
+                    self.scheduler.watch(sheet)
+        return self.running
+
+    def get_data(self, entries, full=False):
+        '''Fetches every (GSheet url, sheet title) in entries'''
+        return self.sheets_client.batchGetData(entries, full)
+
+    def update_data(self, sheets):
+        '''Fetches the sheets with the given indexes into sheet_data'''
+        entries = []
+        for x in sheets:
+            entries += [self.sheet_entries[x]]
+        fetched = self.sheets_client.batchGetData(entries)
+        for x in range(0, len(sheets)):
+            self.sheet_data[sheets[x]] = fetched[x]
+
+    def int_to_column_id(self, num):
+        ''' Converts any positive integer to Base26(letters only) with no 0th case.
+        Useful for applications such as spreadsheet columns to determine which
+        Letterset goes with a positive integer.
+        '''
+        if num <= 0:
+            return ''
+        elif num <= 26:
+            return chr(96 + num)
+        else:
+            return self.int_to_column_id(
+                int((num - 1) / 26)) + chr(97 + (num - 1) % 26)
+
+    def column_id_to_int(self, string):
+        ''' Converts a string from Base26(letters only) with no 0th case to a
+        positive integer. Useful for figuring out column numbers from letters so
+        that they can be called from a list.
+        '''
+        string = string.lower()
+        if string == ' ' or len(string) == 0:
+            return 0
+        if len(string) == 1:
+            return ord(string) - 96
+        else:
+            return self.column_id_to_int(string[1:]) \
+                + (26**(len(string) - 1)) \
+                * (ord(string[0]) - 96)
+
+    def email_command_execution(self, string, data=[], time=None):
+        '''Renders an email template. Returns the html and the list of files
+        to attach.'''
+        return self.render(self.compile_template(string), data, time)
+
+    def compile_template(self, html, plain=False):
+        '''Returns the Template of html, parsing it only the first time it
+        is asked for. Plain templates, for subjects, are filled with the
+        text of the cells rather than html.'''
+        template = self.templates.get((html, plain))
+        if template is None:
+            template = Template.Template(self, html, plain)
+            self.templates[(html, plain)] = template
+        return template
+
+    def render(self, template, data, time=None):
+        '''Renders a compiled template. A template rendered again with the
+        same time before any sheet changes gets the earlier result, so its
+        charts are drawn and its images downloaded once.'''
+        versions = self.data_versions(data)
+        if versions is None:
+            return template.render(data, time)
+        if versions != self.render_versions:
+            self.renders = {}
+            self.render_versions = versions
+        key = (template, time)
+        if key in self.renders:
+            self.render_hits += 1
+        else:
+            self.render_misses += 1
+            self.renders[key] = template.render(data, time)
+        html, attach = self.renders[key]
+        return html, list(attach)
+
+    def data_versions(self, data):
+        '''Identifies the contents of the sheets in data, or returns None if
+        they are not SheetSnapshots'''
+        versions = []
+        for sheet in data:
+            if not isinstance(sheet, Snapshot.SheetSnapshot):
+                return None
+            versions.append((sheet.generation, sheet.version))
+        return tuple(versions)
+
+    def statistics_command(self, data, option, sheet_number, column,
+                           row_range, title=''):
+
+        num1 = 0
+        num2 = 0
+        options = []
+        numbers = []
+        # blank and a: ranges always end at the last row, so their counts
+        # can be kept and added to as rows arrive
+        running = row_range == '' or (row_range.endswith(':') and
+                                      row_range[0] not in ':-')
+
+        if row_range != '':
+
+            if row_range[0] == ':' or row_range[len(row_range) - 1] == ':':
+                if row_range[0] == ':':
+                    row_range = str(
+                        len(data[int(sheet_number) - 1])) + row_range
+                if row_range[len(row_range) - 1] == ':':
+                    row_range = row_range + \
+                        str(len(data[int(sheet_number) - 1]))
+
+            for x in range(0, len(row_range)):
+                if row_range[x] == ':':
+                    temp = int(row_range[:x])
+                    if temp <= int(row_range[x + 1:]):
+                        num1 = temp
+                        num2 = int(row_range[x + 1:])
+                    else:
+                        num1 = int(row_range[x + 1:])
+                        num2 = temp
+                    continue
+        else:
+            num1 = 1
+            num2 = len(data[int(sheet_number) - 1])
+
+        if num1 < 0 or num2 < 0:
+            if num1 < 0:
+                num1 = len(data[int(sheet_number) - 1]) + num1 - 1
+            if num2 < 0:
+                num2 = len(data[int(sheet_number) - 1]) + num2 - 1
+
+        if column.isdigit() == False:
+            column = self.column_id_to_int(column)
+
+        options, numbers = self.statistics_internal(
+            data, sheet_number, column, num1, num2, running)
+
+        output = self.statistics_output(option, title, options, numbers)
+        if output is None:
+            print('statistics error: no choice')
+            return '', None
+        return output
+
+    def time_statistics_command(self, data, option, sheet_number, time,
+                                title=''):
+        options = []
+        numbers = []
+        start = -1
+        stop = 0
+        if time is None:
+            print("Time Stats Error")
+            return '', None
+        else:
+            start, stop = self.timestamp_index(
+                sheet_number, data[int(sheet_number) - 1]).after(time)
+            options, numbers = self.statistics_internal(
+                data, sheet_number, 0, start, stop)
+
+        output = self.statistics_output(option, title, options, numbers)
+        if output is None:
+            print('time statistics error: no choice')
+            return '', None
+        return output
+
+    def statistics_output(self, option, title, options, numbers):
+        '''Renders the counted answers as option asks: num, per, pie, bar or
+        line. Returns the html and the files to attach, or None if option is
+        none of them.'''
+        _return_string = ''
+        if 'num' in option.lower():
+            for x in range(0, len(options)):
+                _return_string += (options[x] + ':' + str(numbers[x]) + ' ')
+            return _return_string, None
+        elif 'per' in option.lower():
+            total = sum(numbers)
+            for x in range(0, len(options)):
+                _return_string += (options[x] + ':' +
+                                   str(int(numbers[x] / total * 100)) + '% ')
+            return _return_string, None
+        elif 'pie' in option.lower():
+            return self.create_pie(title, options, numbers)
+        elif 'bar' in option.lower():
+            return self.create_bar(title, options, numbers)
+        elif 'line' in option.lower():
+            return self.create_line(title, options, numbers)
+        return None
+
+    def statistics_internal(self, data, sheet_number, column, first, last,
+                            running=False):
+        '''Counts the answers in rows first to last of a column. Checkbox
+        answers are split into their choices. Returns the answers in the
+        order they first appear and how often each was given. A running
+        range, which ends at the last row whenever it is asked for, is
+        counted from the kept aggregate.'''
+        sheet = data[int(sheet_number) - 1]
+        if (running and first >= 1 and last == len(sheet) and
+                isinstance(sheet, Snapshot.SheetSnapshot)):
+            cells = self.running_counts(sheet_number, sheet,
+                                        int(column) - 1, first - 1)
+        else:
+            cells = sheet.counts(int(column) - 1, first - 1, last)
+        # each distinct cell is split once, however many rows gave it
+        totals = collections.OrderedDict()
+        for values, count in cells.items():
+            for x in self.split_answers(values):
+                totals[x] = totals.get(x, 0) + count
+        return list(totals.keys()), list(totals.values())
+
+    def running_counts(self, sheet_number, sheet, column, start):
+        '''Returns the counts of column from row start to the end of sheet,
+        counting only the rows added since they were last asked for'''
+        key = (int(sheet_number), column, start)
+        counts = self.aggregates.get(key)
+        if counts is None:
+            counts = self.aggregates[key] = Snapshot.RunningCounts(column,
+                                                                   start)
+        return counts.update(sheet)
+
+    def timestamp_index(self, sheet_number, sheet):
+        '''Returns the times of sheet with its new rows parsed'''
+        index = self.timestamps.get(int(sheet_number))
+        if index is None:
+            index = self.timestamps[int(sheet_number)] = \
+                Snapshot.TimestampIndex()
+        return index.update(sheet)
+
+    def update_aggregates(self, sheets):
+        '''Counts and parses the new rows of the given sheet indexes into
+        the kept aggregates and timestamp indexes'''
+        for (sheet_number, column, start), counts in self.aggregates.items():
+            if sheet_number - 1 in sheets:
+                counts.update(self.sheet_data[sheet_number - 1])
+        for sheet_number, index in self.timestamps.items():
+            if sheet_number - 1 in sheets:
+                index.update(self.sheet_data[sheet_number - 1])
+
+    def split_answers(self, values):
+        '''Splits the choices of a checkbox answer, which are separated by
+        commas and usually a space'''
+        var_list = values.split(',')
+        return var_list[:1] + [x[1:] if x.startswith(' ') else x
+                               for x in var_list[1:]]
+
+    def create_images(self, value):
+        if 'https://drive.google.com/open?id=' in value:
+            if ',' in value:
+                img_list = []
+                img_filelist = []
+                place_holder = 0
+                return_string = ''
+                for x in range(0, len(value)):
+                    if value[x] == ',':
+                        img_list += [value[place_holder:x]]
+                        place_holder = x + 1
+                    if value[x] == ' ':
+                        place_holder += 1
+                    if x == len(value) - 1:
+                        img_list += [value[place_holder:x + 1]]
+                for x in img_list:
+                    img_filename = self.drive_client.download(x)
+                    img_filelist += [img_filename]
+                    return_string += '<img src="cid:' + img_filename + '"/>'
+                return return_string, img_filelist
+            else:
+                img_filename = self.drive_client.download(value)
+                return '<img src="cid:' + img_filename + '"/>', [img_filename]
+        else:
+            return None, None
+
+    def create_pie(self, title, options, numbers):
+        def make_autopct(values):
+            def my_autopct(pct):
+                total = sum(values)
+                val = int(round(pct * total / 100.0))
+                return '{p:.2f}% ({v:d})'.format(p=pct, v=val)
+            return my_autopct
+        plt.pie(numbers, labels=options, autopct=make_autopct(numbers))
+        plt.title(title)
+        plt.axis('equal')
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        graph_dir = os.path.join(home_dir, '.images')
+        counter = 1
+        while True:
+            graphfile = os.path.join(
+                graph_dir,
+                'pie' +
+                self.int_to_column_id(counter).upper() +
+                '.png')
+            if not os.path.exists(graphfile):
+                print(graphfile)
+                plt.savefig('pie' + self.int_to_column_id(counter).upper())
+                break
+            counter += 1
+        plt.clf()
+        return '<img src="cid:' + 'pie' + self.int_to_column_id(counter).upper(
+        ) + '.png' + '"/>', ['pie' + self.int_to_column_id(counter).upper() + '.png']
+
+    def create_bar(self, title, options, numbers):
+        y_pos = np.arange(len(options))
+        plt.bar(y_pos, numbers, align='center')
+        plt.xticks(y_pos, options)
+        plt.title(title)
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        graph_dir = os.path.join(home_dir, '.images')
+        counter = 1
+        while True:
+            graphfile = os.path.join(
+                graph_dir,
+                'bar' +
+                self.int_to_column_id(counter).upper() +
+                '.png')
+            if not os.path.exists(graphfile):
+                print(graphfile)
+                plt.savefig('bar' + self.int_to_column_id(counter).upper())
+                break
+            counter += 1
+        plt.clf()
+        return '<img src="cid:' + 'bar' + self.int_to_column_id(counter).upper(
+        ) + '.png' + '"/>', ['bar' + self.int_to_column_id(counter).upper() + '.png']
+
+    def create_line(self, title, options, numbers):
+        list_x = []
+        for x in range(0, len(options)):
+            list_x += [x]
+        x = np.array(list_x)
+        y = np.array(numbers)
+        plt.xticks(x, options)
+        plt.plot(x, y)
+        plt.title(title)
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        graph_dir = os.path.join(home_dir, '.images')
+        counter = 1
+        while True:
+            graphfile = os.path.join(
+                graph_dir,
+                'line' +
+                self.int_to_column_id(counter).upper() +
+                '.png')
+            if not os.path.exists(graphfile):
+                print(graphfile)
+                plt.savefig(
+                    'line' + self.int_to_column_id(counter).upper())
+                break
+            counter += 1
+        plt.clf()
+        return '<img src="cid:' + 'line' + self.int_to_column_id(counter).upper(
+        ) + '.png' + '"/>', ['line' + self.int_to_column_id(counter).upper() + '.png']
+
+    def check_dirs(self):
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        image_dir = os.path.join(home_dir, '.images')
+        if not os.path.exists(image_dir):
+            os.makedirs(image_dir)
+        os.chdir(image_dir)
+
+    def validate_emails(self, addresses, group):
+        first = 0
+        last = 0
+        for x in range(0, len(addresses)):
+            if addresses[x] == ',':
+                last = x
+                if '.' not in addresses[first:last] or '@' not in addresses[first:last]:
+                    self.create_error("Invalid email address in " + group)
+                    return False
+                first = x
+        if '.' not in addresses[first:] or '@' not in addresses[first:]:
+            self.create_error("Invalid email address in " + group)
+            return False
+        return True
+
+    def delivery_key(self, trigger, suffix):
+        '''Returns the key of the email trigger sends for suffix, the row
+        or time it is sent for, or None for a trigger without a name'''
+        if trigger.name is None:
+            return None
+        return trigger.name + '@' + str(suffix)
+
+    def row_key(self, sheet, row):
+        '''Identifies a row by its timestamp and a hash of its cells, which
+        unlike its row number stay the same when rows above it are
+        deleted'''
+        cells = sheet[row]
+        digest = hashlib.sha1('\x1f'.join(cells).encode('utf-8'))
+        return (cells[0] if cells else '') + '#' + digest.hexdigest()[:16]
+
+    def queue_email(self, to, subject, html, attach, key=None):
+        '''Adds an email to the ones sent together by send_pending. An email
+        whose key was queued before, in this run or an earlier one, is
+        dropped.'''
+        if key is not None:
+            if not self.outbox.reserve(key):
+                print('Already sent', key)
+                return
+            self.outgoing_keys += [key]
+        self.outgoing += [('me', to, subject, html, '', attach)]
+
+    def send_pending(self, send=True):
+        '''Stores the queued emails in the outbox and hands the outbox
+        emails that are due, including retries and emails left from an
+        earlier run, to the send queue without waiting for them to be
+        sent. Emails that do not fit in the queue wait in the outbox. With
+        send false the emails are only stored.'''
+        states = {}
+        for x in self.running_groups:
+            if x.name is not None and \
+                    self.saved_states.get(x.name) != x.state():
+                states[x.name] = x.state()
+        if self.outgoing or states:
+            self.outbox.add(self.outgoing, self.outgoing_keys, states)
+            self.outgoing = []
+            self.outgoing_keys = []
+            self.saved_states.update(states)
+        self.outbox.compact()
+        if not send:
+            return
+        for id, message in self.outbox.claim(self.send_queue.space()):
+            self.send_queue.put(id, message)
+
+    def create_error(self, message):
+        print('Error:', message)
+        self.running = False
+        self.running_groups = []
+        gc.collect()
+
+    def poll(self):
+        '''Polls the sheets that are due and checks every group. Sheets
+        watched by Keyword, Response# and MailMerge groups or read by their
+        emails are polled as often as the scheduler decides; all sheets are
+        fetched when a TimeInterval email is due. Returns the number of
+        seconds until the next poll.'''
+        timed = [x for x in self.running_groups
+                 if isinstance(x, self.TimeInterval)]
+        if [x for x in timed if x.seconds_left() <= 0]:
+            sheets = list(range(0, len(self.sheet_entries)))
+        else:
+            sheets = self.scheduler.due()
+        if sheets:
+            self.update_data(sheets)
+            self.update_aggregates(sheets)
+            for x in sheets:
+                # a sheet that came back empty is still rescheduled, or it
+                # would stay due and be fetched on every pass
+                if x in self.scheduler.sheets:
+                    self.scheduler.record(x, len(self.sheet_data[x] or []))
+        print('Unchanged sheet fetches skipped: ',
+              self.sheets_client.skipped_fetches)
+        for x in self.running_groups:
+            x.check(self, self.sheet_data)
+        self.send_pending()
+        stats = self.send_queue.stats()
+        print('Send queue: %d waiting, %d sent, %d failed, '
+              '%.1fs average wait' % (stats['depth'], stats['sent'],
+                                       stats['failed'], stats['latency_avg']))
+        print('Outbox:', self.outbox.counts())
+        print('Template renders: %d, reused: %d' % (self.render_misses,
+                                                    self.render_hits))
+        waits = RateLimit.shared.summary()
+        if waits:
+            print('Rate limit waits:\n' + waits)
+        wakeups = [time.time() + x.seconds_left() for x in timed]
+        retry = self.outbox.next_attempt()
+        if retry is not None:
+            # due emails that did not fit in the send queue are offered
+            # again a second later
+            wakeups.append(max(retry, time.time() + 1))
+        delay = self.scheduler.next_wake(wakeups)
+        print('Next check in', round(delay, 1), 'seconds')
+        return delay
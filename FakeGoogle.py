@@ -0,0 +1,414 @@
+'''
+In-process stand-in for the Google APIs used by Form2Email.
+
+FakeBackend.build returns service objects that answer the same calls the
+GSheet, GMail and GDrive clients make (Sheets values get/batchGet, Gmail
+messages send and Drive files get/get_media) without touching the network.
+Latency, error rate and the rate at which response sheets grow can be set,
+so the poll, render and send pipeline can be measured offline.
+
+To run the application against it set FORM2EMAIL_FAKE_GOOGLE, e.g.
+    FORM2EMAIL_FAKE_GOOGLE="latency=0.2,error_rate=0.01,growth=0.5"
+'''
+
+from __future__ import print_function
+import os
+import time
+import random
+import string
+import datetime
+import threading
+
+import httplib2
+from apiclient import errors
+
+NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace']
+CHOICES = ['Yes', 'No', 'Maybe']
+TOPICS = ['Math', 'Science', 'History', 'Art']
+
+
+class FakeBackend:
+    '''Builds fake services sharing one set of sheets, mailbox and stats.
+
+    latency: seconds every request takes, or a (min, max) tuple
+    error_rate: chance between 0 and 1 that a request fails with a 503
+    growth: rows added per second to every sheet that has been read
+    rows: number of responses a sheet starts with
+    media_size: bytes returned by a Drive download
+    '''
+
+    def __init__(self, latency=0, error_rate=0, growth=0, rows=100,
+                 media_size=64 * 1024, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.growth = growth
+        self.rows = rows
+        self.media_size = media_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sheets = {}
+        self.versions = {}
+        self.sent = []
+        self.stats = {}
+
+    def build(self, api, version):
+        '''Fake counterpart of discovery.build'''
+        if api == 'sheets':
+            return FakeSheets(self)
+        elif api == 'gmail':
+            return FakeGmail(self)
+        elif api == 'drive':
+            return FakeDrive(self)
+        raise ValueError('FakeBackend has no ' + api + ' ' + version)
+
+    def call(self, endpoint, function):
+        '''Runs function as a request to endpoint, applying latency and
+        errors and recording how long it took'''
+        start = time.time()
+        with self.lock:
+            if isinstance(self.latency, tuple):
+                delay = self.random.uniform(*self.latency)
+            else:
+                delay = self.latency
+        if delay:
+            time.sleep(delay)
+        try:
+            if self.fails():
+                raise error()
+            return function()
+        finally:
+            with self.lock:
+                count, total = self.stats.get(endpoint, (0, 0.0))
+                self.stats[endpoint] = (count + 1, total + time.time() - start)
+
+    def fails(self):
+        '''Decides whether a request fails'''
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def summary(self):
+        '''Returns a printable table of request counts and mean latencies'''
+        lines = []
+        with self.lock:
+            for endpoint in sorted(self.stats):
+                count, total = self.stats[endpoint]
+                lines.append('%-24s %8d requests %10.2f ms avg' %
+                             (endpoint, count, total / count * 1000))
+            lines.append('%-24s %8d' % ('messages sent', len(self.sent)))
+        return '\n'.join(lines)
+
+    def sheet(self, spreadsheetId, sheetName):
+        '''Returns the rows of a sheet, creating and growing it as needed.
+        Must be called with the lock held.'''
+        key = (spreadsheetId, sheetName)
+        now = time.time()
+        if key not in self.sheets:
+            rows = [['Timestamp', 'Name', 'Attending', 'Topics', 'Email']]
+            self.sheets[key] = [rows, now, 0.0]
+            # the sheet stands for one that already existed, so creating
+            # it does not count as a change
+            self.versions.setdefault(spreadsheetId, 1)
+            self.addRows(key, self.rows)
+        entry = self.sheets[key]
+        entry[2] += (now - entry[1]) * self.growth
+        entry[1] = now
+        if entry[2] >= 1:
+            self.addRows(key, int(entry[2]))
+            entry[2] -= int(entry[2])
+            self.versions[spreadsheetId] += 1
+        return entry[0]
+
+    def touch(self, spreadsheetId):
+        '''Grows every sheet of a spreadsheet so its version is current.
+        Must be called with the lock held.'''
+        for key in list(self.sheets):
+            if key[0] == spreadsheetId:
+                self.sheet(*key)
+
+    def addRows(self, key, count):
+        rows = self.sheets[key][0]
+        for x in range(0, count):
+            stamp = datetime.datetime.now() - datetime.timedelta(
+                seconds=count - x)
+            topics = self.random.sample(TOPICS, self.random.randint(1, 3))
+            name = self.random.choice(NAMES)
+            rows.append([stamp.strftime('%m/%d/%Y %H:%M:%S'),
+                         name,
+                         self.random.choice(CHOICES),
+                         ', '.join(topics),
+                         name.lower() + '@example.com'])
+
+    def deliver(self, size):
+        '''Records a sent message of size bytes and returns the response
+        to the send'''
+        with self.lock:
+            self.sent.append(size)
+            return {'id': '%016x' % len(self.sent), 'labelIds': ['SENT']}
+
+    def values(self, spreadsheetId, rangeName):
+        '''Returns a ValueRange for an A1 range such as Sheet1,
+        'Sheet 1'!A5:ZZ or Sheet1!A2:D10'''
+        sheetName, first, last = parseRange(rangeName)
+        with self.lock:
+            rows = self.sheet(spreadsheetId, sheetName)
+            if last is None:
+                last = len(rows)
+            values = [list(row) for row in rows[first - 1:last]]
+        return {'range': rangeName, 'majorDimension': 'ROWS',
+                'values': values}
+
+
+def error(status=503):
+    return errors.HttpError(httplib2.Response({'status': status}),
+                            b'Backend Error')
+
+
+def parseRange(rangeName):
+    '''Splits an A1 range into sheet name, first row and last row (None
+    when open ended). Columns are ignored.'''
+    if '!' not in rangeName:
+        return rangeName, 1, None
+    sheetName, cells = rangeName.rsplit('!', 1)
+    if sheetName.startswith("'") and sheetName.endswith("'"):
+        sheetName = sheetName[1:-1].replace("''", "'")
+    rows = []
+    for cell in cells.split(':'):
+        digits = cell.lstrip(string.ascii_letters)
+        rows.append(int(digits) if digits else None)
+    first = rows[0] or 1
+    last = rows[1] if len(rows) > 1 else rows[0]
+    return sheetName, first, last
+
+
+class FakeRequest:
+    '''Mimics an apiclient HttpRequest'''
+
+    def __init__(self, backend, endpoint, function):
+        self.backend = backend
+        self.endpoint = endpoint
+        self.function = function
+
+    def execute(self, num_retries=0):
+        return self.backend.call(self.endpoint, self.function)
+
+
+class FakeSheets:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range):
+        return FakeRequest(
+            self.backend, 'sheets.values.get',
+            lambda: self.backend.values(spreadsheetId, range))
+
+    def batchGet(self, spreadsheetId, ranges):
+        def function():
+            return {'spreadsheetId': spreadsheetId,
+                    'valueRanges': [self.backend.values(spreadsheetId, x)
+                                    for x in ranges]}
+        return FakeRequest(self.backend, 'sheets.values.batchGet', function)
+
+
+class FakeGmail:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body=None, media_body=None):
+        if media_body is not None:
+            return FakeUploadRequest(self.backend, media_body)
+
+        def function():
+            return self.backend.deliver(len(body.get('raw', '')))
+        return FakeRequest(self.backend, 'gmail.messages.send', function)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback)
+
+
+class FakeUploadRequest:
+    '''Mimics a resumable media upload request. Every next_chunk call
+    uploads one chunk of the media and a failed chunk leaves the upload
+    where it was, so calling next_chunk again resumes it.'''
+
+    def __init__(self, backend, media):
+        self.backend = backend
+        self.media = media
+        self.progress = 0
+
+    def next_chunk(self, num_retries=0):
+        size = self.media.size()
+
+        def function():
+            data = self.media.getbytes(self.progress, self.media.chunksize())
+            self.progress += len(data)
+            if self.progress < size:
+                return FakeProgress(self.progress, size), None
+            return None, self.backend.deliver(size)
+        for attempt in range(0, num_retries + 1):
+            try:
+                return self.backend.call('gmail.messages.send.upload',
+                                         function)
+            except errors.HttpError:
+                if attempt == num_retries:
+                    raise
+
+
+class FakeProgress:
+
+    def __init__(self, progress, size):
+        self.resumable_progress = progress
+        self.total_size = size
+
+    def progress(self):
+        return float(self.resumable_progress) / self.total_size
+
+
+class FakeBatch:
+    '''Mimics an apiclient BatchHttpRequest. The batch costs one request
+    of latency and every call in it can fail on its own.'''
+
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self.requests) + 1)
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        def function():
+            for request_id, request, callback in self.requests:
+                if self.backend.fails():
+                    callback(request_id, None, error())
+                else:
+                    callback(request_id, request.function(), None)
+        self.backend.call('gmail.batch', function)
+
+
+class FakeDrive:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return self
+
+    def get(self, fileId, fields=None):
+        def function():
+            with self.backend.lock:
+                self.backend.touch(fileId)
+                return {'id': fileId,
+                        'version': str(self.backend.versions.get(fileId, 1))}
+        return FakeRequest(self.backend, 'drive.files.get', function)
+
+    def get_media(self, fileId):
+        return FakeMediaRequest(self.backend, fileId)
+
+
+class FakeMediaRequest:
+    '''Request handed to MediaIoBaseDownload, which reads the file in
+    chunks through request.http'''
+
+    def __init__(self, backend, fileId):
+        self.uri = 'https://fake.googleapis.com/drive/v3/files/' + fileId
+        self.headers = {}
+        self.http = FakeMediaHttp(backend)
+
+
+class FakeMediaHttp:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        size = self.backend.media_size
+        first, last = 0, size - 1
+        if headers and 'range' in headers:
+            first, last = [int(x) for x in
+                           headers['range'].split('=')[1].split('-')]
+            last = min(last, size - 1)
+
+        def function():
+            response = httplib2.Response({
+                'status': 206,
+                'content-range': 'bytes %d-%d/%d' % (first, last, size)})
+            return response, b'\0' * (last - first + 1)
+        return self.backend.call('drive.files.get_media', function)
+
+
+def fromEnvironment():
+    '''Returns a FakeBackend configured by FORM2EMAIL_FAKE_GOOGLE, or None
+    when the variable is not set'''
+    setting = os.environ.get('FORM2EMAIL_FAKE_GOOGLE')
+    if setting is None:
+        return None
+    options = {}
+    for item in setting.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            options[name.strip()] = float(value)
+    for name in ('rows', 'media_size', 'seed'):
+        if name in options:
+            options[name] = int(options[name])
+    print('Using fake Google backend:', options)
+    return FakeBackend(**options)
+
+
+if __name__ == '__main__':
+    import argparse
+    import GSheet
+    import GMail
+    import RateLimit
+
+    argparser = argparse.ArgumentParser(
+        description='Poll and send against the fake backend and report '
+                    'throughput and latency.')
+    argparser.add_argument('--spreadsheets', type=int, default=2)
+    argparser.add_argument('--tabs', type=int, default=5)
+    argparser.add_argument('--cycles', type=int, default=10)
+    argparser.add_argument('--latency', type=float, default=0.05)
+    argparser.add_argument('--error-rate', type=float, default=0)
+    argparser.add_argument('--growth', type=float, default=5)
+    argparser.add_argument('--rows', type=int, default=1000)
+    args, unknown = argparser.parse_known_args()
+
+    backend = FakeBackend(latency=args.latency, error_rate=args.error_rate,
+                          growth=args.growth, rows=args.rows, seed=0)
+    client = GSheet.SheetsClient(incremental=True, backend=backend)
+    mailer = GMail.GmailSender(backend=backend)
+    entries = []
+    for x in range(0, args.spreadsheets):
+        for y in range(0, args.tabs):
+            entries.append(('https://docs.google.com/spreadsheets/d/bench' +
+                            str(x) + '/edit', 'Form ' + str(y)))
+
+    start = time.time()
+    for cycle in range(0, args.cycles):
+        cycle_start = time.time()
+        data = client.batchGetData(entries)
+        for values in data:
+            mailer.SendMessage('me', 'bench@example.com', 'Bench',
+                               '<p>' + str(len(values)) + ' rows</p>', '')
+        print('cycle', cycle, '%.3fs' % (time.time() - cycle_start))
+    elapsed = time.time() - start
+    client.executor.shutdown()
+    print(backend.summary())
+    print(RateLimit.shared.summary())
+    print('%d cycles in %.2fs (%.3fs per cycle)' %
+          (args.cycles, elapsed, elapsed / args.cycles))
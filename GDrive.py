@@ -2,6 +2,7 @@ from __future__ import print_function
 import httplib2
 import os
 import io
+import threading
 
 from apiclient import discovery
 from apiclient.http import MediaIoBaseDownload
@@ -9,9 +10,12 @@ from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
+import RateLimit
+
 try:
     import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+    flags = argparse.ArgumentParser(
+        parents=[tools.argparser]).parse_known_args()[0]
 except ImportError:
     flags = None
 
@@ -56,28 +60,76 @@ def getDriveID(url):
     return driveid
 
 
+class DriveClient:
+    '''Long-lived Drive API client. Keeps the authorized http connection
+    and the built service between calls, one per thread, and refreshes
+    expired tokens. backend replaces the Google API with a stand-in such
+    as FakeGoogle.FakeBackend. Requests are paced by limiter,
+    RateLimit.shared unless given.
+    '''
+
+    def __init__(self, credfile=CLIENT_SECRET_FILE, backend=None,
+                 limiter=None):
+        self.credfile = credfile
+        self.backend = backend
+        self.limiter = limiter if limiter is not None else RateLimit.shared
+        self.credentials = None
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def getService(self):
+        if self.backend is not None:
+            return self.backend.build('drive', 'v3')
+        with self.lock:
+            if self.credentials is None or self.credentials.invalid:
+                self.credentials = get_credentials(self.credfile)
+                self.generation += 1
+            elif self.credentials.access_token_expired:
+                self.credentials.refresh(httplib2.Http())
+        if getattr(self.local, 'generation', None) != self.generation:
+            self.local.http = self.credentials.authorize(httplib2.Http())
+            self.local.service = discovery.build(
+                'drive', 'v3', http=self.local.http)
+            self.local.generation = self.generation
+        return self.local.service
+
+    def getVersion(self, file_id):
+        '''Returns the version number of a Drive file. It increases on
+        every change, so it is a cheap way to see whether a spreadsheet
+        needs to be fetched again.'''
+        self.limiter.acquire('drive', 'files.get')
+        result = self.getService().files().get(
+            fileId=file_id, fields='version').execute()
+        return result.get('version')
+
+    def download(self, fileURL):
+        '''Downloads the file at fileURL into the .images directory and
+        returns its filename'''
+        drive_service = self.getService()
+
+        home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+        image_dir = os.path.join(home_dir, '.images')
+        if not os.path.exists(image_dir):
+            os.makedirs(image_dir)
+        os.chdir(image_dir)
+
+        file_id = getDriveID(fileURL)
+        request = drive_service.files().get_media(fileId=file_id)
+        filename = file_id + '.tiff'
+        with io.FileIO(filename, 'wb') as fh:
+            downloader = MediaIoBaseDownload(fh, request)
+            done = False
+            while done is False:
+                self.limiter.acquire('drive', 'files.get_media')
+                status, done = downloader.next_chunk()
+                print("Downloading " + filename + " %d%%." %
+                      int(status.progress() * 100))
+        return filename
+
+
 def download(fileURL, credfile=CLIENT_SECRET_FILE):
     """
     Creates a Google Drive API service object and downloads file specified
     """
-    credentials = get_credentials(credfile)
-    http = credentials.authorize(httplib2.Http())
-    drive_service = discovery.build('drive', 'v3', http=http)
-
-    home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
-    image_dir = os.path.join(home_dir, '.images')
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir)
-    os.chdir(image_dir)
-
-    file_id = getDriveID(fileURL)
-    request = drive_service.files().get_media(fileId=file_id)
-    filename = file_id + '.tiff'
-    fh = io.FileIO(filename, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        print("Downloading " + filename + " %d%%." %
-              int(status.progress() * 100))
-    return filename
+    return DriveClient(credfile).download(fileURL)
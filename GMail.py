@@ -1,15 +1,24 @@
 from __future__ import print_function
 import httplib2
 import os
+import time
+import tempfile
+import threading
+import collections
+import http.client
 
 from apiclient import discovery
 from apiclient import errors
+from apiclient.http import MediaIoBaseUpload
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
+import RateLimit
+
 
 import base64
+from email import generator
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import mimetypes
@@ -19,13 +28,33 @@ from email.mime.base import MIMEBase
 
 try:
     import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+    flags = argparse.ArgumentParser(
+        parents=[tools.argparser]).parse_known_args()[0]
 except ImportError:
     flags = None
 
 SCOPES = 'https://www.googleapis.com/auth/gmail.send'
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'Form2Email'
+# Gmail accepts up to 100 calls per batch but recommends no more than 50
+BATCH_SIZE = 50
+# statuses worth sending again: rate limits and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# errors of the connection rather than of the request, e.g. timeouts,
+# dropped connections and failed DNS lookups, which are also worth
+# sending again
+NETWORK_ERRORS = (OSError, httplib2.HttpLib2Error, http.client.HTTPException)
+# OSErrors of local files such as a missing attachment, which are not
+FILE_ERRORS = (FileNotFoundError, IsADirectoryError, NotADirectoryError,
+               PermissionError)
+RETRY_DELAY = 1
+# messages bigger than this are streamed through the media upload endpoint
+# instead of being sent base64 encoded in a json body
+UPLOAD_THRESHOLD = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_RETRIES = 3
+# memory kept for built attachment parts shared between emails
+ATTACHMENT_CACHE_BYTES = 32 * 1024 * 1024
 
 
 def get_credentials(credfile):
@@ -49,6 +78,198 @@ def get_credentials(credfile):
     return credentials
 
 
+class GmailSender:
+    '''Long-lived Gmail API client.
+
+    Keeps the authorized http connection, which httplib2 keeps alive
+    between requests, and the built service for the life of the run, so
+    each message only costs its send call. Tokens are refreshed when they
+    expire. Every thread gets its own connection and service.
+
+    backend replaces the Google API with a stand-in such as
+    FakeGoogle.FakeBackend. Sends are paced by limiter, RateLimit.shared
+    unless given.
+    '''
+
+    def __init__(self, credfile=CLIENT_SECRET_FILE, backend=None,
+                 limiter=None):
+        self.credfile = credfile
+        self.backend = backend
+        self.limiter = limiter if limiter is not None else RateLimit.shared
+        self.credentials = None
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def getService(self):
+        if self.backend is not None:
+            return self.backend.build('gmail', 'v1')
+        with self.lock:
+            if self.credentials is None or self.credentials.invalid:
+                self.credentials = get_credentials(self.credfile)
+                self.generation += 1
+            elif self.credentials.access_token_expired:
+                self.credentials.refresh(httplib2.Http())
+        if getattr(self.local, 'generation', None) != self.generation:
+            self.local.http = self.credentials.authorize(httplib2.Http())
+            self.local.service = discovery.build(
+                'gmail', 'v1', http=self.local.http)
+            self.local.generation = self.generation
+        return self.local.service
+
+    def SendMessage(self, sender, to, subject, msgHtml, msgPlain,
+                    attachmentFile=None):
+        if messageSize(msgHtml, msgPlain, attachmentFile) > UPLOAD_THRESHOLD:
+            try:
+                message = self.uploadMessage(sender, to, subject, msgHtml,
+                                             msgPlain, attachmentFile)
+                print('Message Id: %s' % message['id'])
+                return message
+            except errors.HttpError as error:
+                print('An error occurred: %s' % error)
+                return 'Error'
+        message1 = CreateMessage(sender, to, subject, msgHtml, msgPlain,
+                                 attachmentFile)
+        self.limiter.acquire('gmail', 'messages.send')
+        return SendMessageInternal(self.getService(), 'me', message1)
+
+    def SendBatch(self, messages, retries=2, failures=None):
+        '''Sends a list of (sender, to, subject, msgHtml, msgPlain,
+        attachmentFile) tuples as Gmail batch requests of up to BATCH_SIZE
+        messages. Messages that fail with a rate limit or server error are
+        sent again in a later batch, up to retries times.
+
+        Returns one result per message, in order: the sent message, or
+        'Error' if it could not be sent. If failures is a dict, the error
+        of every message that could not be sent is stored in it by index.
+        '''
+        results = ['Error'] * len(messages)
+        exceptions = {}
+        bodies = {}
+        pending = list(range(0, len(messages)))
+        for attempt in range(0, retries + 1):
+            failed = []
+            for start in range(0, len(pending), BATCH_SIZE):
+                self.executeBatch(messages, pending[start:start + BATCH_SIZE],
+                                  bodies, results, failed, exceptions,
+                                  attempt == retries)
+            if not failed:
+                break
+            print(len(failed), 'messages failed, retrying...')
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+            pending = sorted(failed)
+        if failures is not None:
+            for x in range(0, len(messages)):
+                if results[x] == 'Error':
+                    failures[x] = exceptions[x]
+        return results
+
+    def executeBatch(self, messages, chunk, bodies, results, failed,
+                     exceptions, last):
+        '''Sends the messages with the indexes in chunk as one batch,
+        storing what was sent in results, the errors of the rest in
+        exceptions and adding the indexes of retryable failures to
+        failed'''
+        service = self.getService()
+
+        def callback(request_id, response, exception):
+            x = int(request_id)
+            if exception is None:
+                print('Message Id: %s' % response['id'])
+                results[x] = response
+                return
+            exceptions[x] = exception
+            if isRetryable(exception) and not last:
+                failed.append(x)
+            else:
+                print('An error occurred: %s' % exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for x in chunk:
+            if x not in bodies and messageSize(*messages[x][3:]) > \
+                    UPLOAD_THRESHOLD:
+                # media uploads cannot be part of a batch
+                self.uploadOne(messages, x, results, failed, exceptions, last)
+                continue
+            if x not in bodies:
+                try:
+                    bodies[x] = CreateMessage(*messages[x])
+                except (IOError, OSError) as error:
+                    # e.g. a missing attachment; the other messages are
+                    # still sent
+                    print('An error occurred: %s' % error)
+                    exceptions[x] = error
+                    continue
+            batch.add(service.users().messages().send(userId='me',
+                                                      body=bodies[x]),
+                      request_id=str(x))
+        added = len([x for x in chunk if x in bodies])
+        if not added:
+            return
+        # every call in a batch counts against the quota on its own
+        self.limiter.acquire('gmail', 'messages.send', added)
+        try:
+            batch.execute()
+        except (errors.HttpError,) + NETWORK_ERRORS as error:
+            # the batch itself failed, so none of its callbacks ran
+            for x in chunk:
+                if x in bodies:
+                    exceptions[x] = error
+                    if isRetryable(error) and not last:
+                        failed.append(x)
+            print('An error occurred: %s' % error)
+
+    def uploadOne(self, messages, x, results, failed, exceptions, last):
+        '''Sends messages[x] with uploadMessage, recording the outcome the
+        way executeBatch does'''
+        try:
+            results[x] = self.uploadMessage(*messages[x])
+            print('Message Id: %s' % results[x]['id'])
+        except (errors.HttpError,) + NETWORK_ERRORS as error:
+            exceptions[x] = error
+            if isRetryable(error) and not last:
+                failed.append(x)
+            else:
+                print('An error occurred: %s' % error)
+
+    def uploadMessage(self, sender, to, subject, msgHtml, msgPlain,
+                      attachmentFile=None):
+        '''Sends an email through the Gmail media upload endpoint.
+
+        The message is written to a temporary file by writeMessage and
+        uploaded from it in UPLOAD_CHUNK_SIZE pieces as a resumable upload,
+        so it is never held in memory whole. A piece that fails with a rate
+        limit or server error is sent again and the upload carries on from
+        the last byte Gmail received. Returns the sent message.
+        '''
+        with tempfile.TemporaryFile() as spool:
+            writeMessage(spool, sender, to, subject, msgHtml, msgPlain,
+                         attachmentFile)
+            spool.seek(0)
+            media = MediaIoBaseUpload(spool, mimetype='message/rfc822',
+                                      chunksize=UPLOAD_CHUNK_SIZE,
+                                      resumable=True)
+            self.limiter.acquire('gmail', 'messages.send')
+            request = self.getService().users().messages().send(
+                userId='me', media_body=media)
+            response = None
+            while response is None:
+                status, response = request.next_chunk(
+                    num_retries=UPLOAD_RETRIES)
+                if status:
+                    print('Uploading message %d%%.' %
+                          int(status.progress() * 100))
+            return response
+
+
+def isRetryable(error):
+    '''Whether a failed request is worth sending again'''
+    if isinstance(error, errors.HttpError):
+        return error.resp.status in RETRY_STATUSES
+    return (isinstance(error, NETWORK_ERRORS) and
+            not isinstance(error, FILE_ERRORS))
+
+
 def SendMessage(
         sender,
         to,
@@ -56,17 +277,13 @@ def SendMessage(
         msgHtml,
         msgPlain,
         attachmentFile=None,
-        credfile=CLIENT_SECRET_FILE):
-    credentials = get_credentials(credfile)
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
-    if attachmentFile:
-        message1 = createMessageWithAttachment(sender, to, subject, msgHtml,
-                                               msgPlain, attachmentFile)
-    else:
-        message1 = CreateMessageHtml(sender, to, subject, msgHtml, msgPlain)
-    result = SendMessageInternal(service, 'me', message1)
-    return result
+        credfile=CLIENT_SECRET_FILE,
+        backend=None):
+    '''One-off send. Long running callers should keep a GmailSender
+    instead so the service is not rebuilt for every message.
+    '''
+    return GmailSender(credfile, backend).SendMessage(
+        sender, to, subject, msgHtml, msgPlain, attachmentFile)
 
 
 def SendMessageInternal(service, user_id, message):
@@ -81,14 +298,91 @@ def SendMessageInternal(service, user_id, message):
     return 'OK'
 
 
+def imageDir():
+    '''Returns the directory attachments are read from, creating it if
+    needed'''
+    home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
+    image_dir = os.path.join(home_dir, '.images')
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+    return image_dir
+
+
+def messageSize(msgHtml, msgPlain, attachmentFile=None):
+    '''Rough size in bytes of a message before it is encoded'''
+    size = len(msgHtml) + len(msgPlain)
+    for attachment in attachmentFile or ():
+        try:
+            size += os.path.getsize(os.path.join(imageDir(), attachment))
+        except OSError:
+            pass
+    return size
+
+
+def CreateMessage(sender, to, subject, msgHtml, msgPlain, attachmentFile=None):
+    return encodeMessage(buildMessage(sender, to, subject, msgHtml, msgPlain,
+                                      attachmentFile))
+
+
+def buildMessage(sender, to, subject, msgHtml, msgPlain, attachmentFile=None):
+    '''Returns the MIME message for an email'''
+    if attachmentFile:
+        return buildMessageWithAttachment(sender, to, subject, msgHtml,
+                                          msgPlain, attachmentFile)
+    return buildMessageHtml(sender, to, subject, msgHtml, msgPlain)
+
+
+def encodeMessage(message):
+    '''Returns the json body that sends a MIME message'''
+    return {'raw': base64.urlsafe_b64encode(
+        message.as_string().encode()).decode()}
+
+
+def writeMessage(spool, sender, to, subject, msgHtml, msgPlain,
+                 attachmentFile=None):
+    '''Writes an email to the binary file spool as MIME. Attachments are
+    read and base64 encoded a few lines at a time, so only the text parts
+    of the email are ever in memory.'''
+    if not attachmentFile:
+        generator.BytesGenerator(spool, mangle_from_=False).flatten(
+            buildMessageHtml(sender, to, subject, msgHtml, msgPlain))
+        return
+    # the email without its attachments, whose closing boundary is moved
+    # after the attachments
+    text = buildMessageWithAttachment(sender, to, subject, msgHtml,
+                                      msgPlain, ()).as_bytes()
+    boundary = b'\n--' + text.rsplit(b'\n--', 1)[1].rstrip()[:-2]
+    spool.write(text[:text.rindex(boundary)])
+    for attachment in attachmentFile:
+        content_type, encoding = mimetypes.guess_type(attachment)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        part = MIMEBase(*content_type.split('/', 1))
+        part.add_header('Content-Transfer-Encoding', 'base64')
+        part.add_header('Content-Disposition', 'attachment',
+                        filename=os.path.basename(attachment))
+        part.add_header('Content-ID', str('<' + attachment + '>'))
+        spool.write(boundary + b'\n' + part.as_bytes())
+        with open(os.path.join(imageDir(), attachment), 'rb') as fp:
+            # 57 bytes encode to one 76 character line
+            for piece in iter(lambda: fp.read(57 * 1024), b''):
+                spool.write(base64.encodebytes(piece))
+    spool.write(boundary + b'--\n')
+
+
 def CreateMessageHtml(sender, to, subject, msgHtml, msgPlain):
+    return encodeMessage(buildMessageHtml(sender, to, subject, msgHtml,
+                                          msgPlain))
+
+
+def buildMessageHtml(sender, to, subject, msgHtml, msgPlain):
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
     msg['From'] = sender
     msg['To'] = to
     msg.attach(MIMEText(msgPlain, 'plain'))
     msg.attach(MIMEText(msgHtml, 'html'))
-    return {'raw': base64.urlsafe_b64encode(msg.as_string().encode()).decode()}
+    return msg
 
 
 def createMessageWithAttachment(
@@ -104,6 +398,13 @@ def createMessageWithAttachment(
     Returns:
       An object containing a base64url encoded email object.
     '''
+    return encodeMessage(buildMessageWithAttachment(
+        sender, to, subject, msgHtml, msgPlain, attachmentFile))
+
+
+def buildMessageWithAttachment(
+        sender, to, subject, msgHtml, msgPlain, attachmentFile):
+    '''Same as createMessageWithAttachment, but returns the MIME message'''
     message = MIMEMultipart('mixed')
     message['to'] = to
     message['from'] = sender
@@ -118,34 +419,83 @@ def createMessageWithAttachment(
 
     message.attach(messageA)
 
-    home_dir = os.path.abspath(os.path.join(__file__, os.pardir))
-    image_dir = os.path.join(home_dir, '.images')
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir)
-    os.chdir(image_dir)
+    os.chdir(imageDir())
 
     print('create_message_with_attachment: file:', attachmentFile)
 
     for x in range(0, len(attachmentFile)):
-        content_type, encoding = mimetypes.guess_type(attachmentFile[x])
+        message.attach(attachments.get(attachmentFile[x]))
 
-        if content_type is None or encoding is not None:
-            content_type = 'application/octet-stream'
-        main_type, sub_type = content_type.split('/', 1)
-        with open(attachmentFile[x], 'rb') as fp:
-            if main_type == 'text':
-                msg = MIMEText(fp.read(), _subtype=sub_type)
-            elif main_type == 'image':
-                msg = MIMEImage(fp.read(), _subtype=sub_type)
-            elif main_type == 'audio':
-                msg = MIMEAudio(fp.read(), _subtype=sub_type)
-            else:
-                msg = MIMEBase(main_type, sub_type)
-                msg.set_payload(fp.read())
-        filename = os.path.basename(attachmentFile[x])
-        msg.add_header('Content-Disposition', 'attachment', filename=filename)
-        msg.add_header('Content-ID', str('<' + attachmentFile[x] + '>'))
-        message.attach(msg)
+    return message
 
-    return {'raw': base64.urlsafe_b64encode(
-        message.as_string().encode()).decode()}
+
+def buildAttachment(attachmentFile):
+    '''Returns the MIME part attaching a file in the images directory'''
+    content_type, encoding = mimetypes.guess_type(attachmentFile)
+
+    if content_type is None or encoding is not None:
+        content_type = 'application/octet-stream'
+    main_type, sub_type = content_type.split('/', 1)
+    with open(os.path.join(imageDir(), attachmentFile), 'rb') as fp:
+        if main_type == 'text':
+            msg = MIMEText(fp.read(), _subtype=sub_type)
+        elif main_type == 'image':
+            msg = MIMEImage(fp.read(), _subtype=sub_type)
+        elif main_type == 'audio':
+            msg = MIMEAudio(fp.read(), _subtype=sub_type)
+        else:
+            msg = MIMEBase(main_type, sub_type)
+            msg.set_payload(fp.read())
+    filename = os.path.basename(attachmentFile)
+    msg.add_header('Content-Disposition', 'attachment', filename=filename)
+    msg.add_header('Content-ID', str('<' + attachmentFile + '>'))
+    return msg
+
+
+class AttachmentCache:
+    '''Built attachment parts, so a chart or image sent to several groups
+    is read and encoded once.
+
+    Parts are keyed by path, size and modification time, so a file that is
+    written again, such as a chart redrawn with new data, is built again.
+    The least recently used parts are dropped once the encoded parts take
+    more than max_bytes. Parts are shared between messages and must not be
+    changed.
+    '''
+
+    def __init__(self, max_bytes=ATTACHMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.parts = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, attachmentFile):
+        info = os.stat(os.path.join(imageDir(), attachmentFile))
+        key = (attachmentFile, info.st_size, info.st_mtime_ns)
+        with self.lock:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+                self.hits += 1
+                return self.parts[key][0]
+            self.misses += 1
+        part = buildAttachment(attachmentFile)
+        size = len(part.get_payload())
+        if size > self.max_bytes:
+            return part
+        with self.lock:
+            if key not in self.parts:
+                # an older version of the file will not be sent again
+                for oldKey in [x for x in self.parts
+                               if x[0] == attachmentFile]:
+                    self.size -= self.parts.pop(oldKey)[1]
+                self.parts[key] = (part, size)
+                self.size += size
+            while self.size > self.max_bytes:
+                oldKey, (oldPart, oldSize) = self.parts.popitem(last=False)
+                self.size -= oldSize
+        return part
+
+
+attachments = AttachmentCache()
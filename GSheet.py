@@ -1,15 +1,24 @@
 from __future__ import print_function
 import httplib2
 import os
+import json
+import hashlib
+import time
+import threading
+import concurrent.futures
 
 from apiclient import discovery
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
+import Snapshot
+import RateLimit
+
 try:
     import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+    flags = argparse.ArgumentParser(
+        parents=[tools.argparser]).parse_known_args()[0]
 except ImportError:
     flags = None
 
@@ -17,6 +26,9 @@ except ImportError:
 SCOPES = 'https://www.googleapis.com/auth/spreadsheets.readonly'
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'Form2Email'
+# default number of spreadsheets fetched at once and seconds to wait for one
+MAX_WORKERS = 4
+TIMEOUT = 30
 
 
 def get_credentials(credfile):
@@ -61,24 +73,392 @@ def getSheetID(url):
     return sheetid
 
 
-def getData(url, sheetName, credfile=CLIENT_SECRET_FILE):
+def tailRange(sheetName, row):
+    '''A1 range covering every row of sheetName from row downwards'''
+    return "'" + sheetName.replace("'", "''") + "'!A" + str(row) + ':ZZ'
+
+
+class FetchJob:
+    '''One spreadsheet being fetched on the worker pool'''
+
+    def __init__(self, sheetNames, full):
+        self.sheetNames = sheetNames
+        self.full = full
+        self.future = None
+        # when the worker started, None while it waits for a thread
+        self.started = None
+        # set once the fetched values are in the snapshots
+        self.applied = False
+        # set when the caller stops waiting; the worker then drops what it
+        # fetched rather than change snapshots the caller already has
+        self.abandoned = False
+
+    def serves(self, sheetNames, full):
+        '''Whether the job is still running and fetches everything a call
+        for sheetNames needs'''
+        return (not self.future.done() and not self.abandoned and
+                (self.full or not full) and
+                set(sheetNames) <= set(self.sheetNames))
+
+
+class SheetsClient:
+    '''Long-lived Sheets API client.
+
+    Keeps the credentials, the authorized http connection and the built
+    service between calls so a poll cycle only pays for the values
+    requests themselves. Tokens are refreshed when they expire.
+
+    Spreadsheets are fetched on a pool of at most max_workers threads. As
+    httplib2 connections are not thread safe every worker keeps its own.
+
+    backend replaces the Google API with a stand-in such as
+    FakeGoogle.FakeBackend.
+
+    With a cache_dir every snapshot is also saved to disk, and a new client
+    starts from the saved snapshots so a restart only fetches what changed.
+
+    Requests are paced by limiter, RateLimit.shared unless given.
     '''
+
+    def __init__(self, credfile=CLIENT_SECRET_FILE, incremental=False,
+                 full_refresh_every=30, drive=None, max_workers=MAX_WORKERS,
+                 timeout=TIMEOUT, backend=None, cache_dir=None, limiter=None):
+        self.credfile = credfile
+        self.backend = backend
+        self.limiter = limiter if limiter is not None else RateLimit.shared
+        self.credentials = None
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # parallel fetching
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.inflight = {}
+        # incremental polling state, keyed by (spreadsheetId, sheetName)
+        self.incremental = incremental
+        self.full_refresh_every = full_refresh_every
+        self.snapshots = {}
+        self.polls = {}
+        # optional GDrive.DriveClient used to skip unchanged spreadsheets
+        self.drive = drive
+        self.versions = {}
+        self.skipped_fetches = 0
+        # snapshots saved between runs
+        self.cache_dir = cache_dir
+        self.saved = {}
+        # (Drive version, tabs) last saved for each spreadsheet
+        self.saved_versions = {}
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def getService(self):
+        '''Returns the cached service, building it on first use and
+        refreshing the access token if it has expired. Each thread gets
+        its own http connection and service.'''
+        if self.backend is not None:
+            return self.backend.build('sheets', 'v4')
+        with self.lock:
+            if self.credentials is None or self.credentials.invalid:
+                self.credentials = get_credentials(self.credfile)
+                self.generation += 1
+            elif self.credentials.access_token_expired:
+                self.credentials.refresh(httplib2.Http(timeout=self.timeout))
+        if getattr(self.local, 'generation', None) != self.generation:
+            self.local.http = self.credentials.authorize(
+                httplib2.Http(timeout=self.timeout))
+            discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
+                            'version=v4')
+            self.local.service = discovery.build(
+                'sheets', 'v4', http=self.local.http,
+                discoveryServiceUrl=discoveryUrl)
+            self.local.generation = self.generation
+        return self.local.service
+
+    def getData(self, url, sheetName):
+        '''Returns the values of sheetName in the spreadsheet at url'''
+        service = self.getService()
+        spreadsheetId = getSheetID(url)
+        rangeName = sheetName
+        self.limiter.acquire('sheets', 'values.get')
+        result = service.spreadsheets().values().get(
+            spreadsheetId=spreadsheetId, range=rangeName).execute()
+        values = result.get('values', [])
+
+        if not values:
+            print('No data found.')
+        else:
+            return values
+
+    def batchGetData(self, entries, full=False):
+        '''Fetches several sheets at once. entries is a list of
+        (url, sheetName) pairs. Entries that share a spreadsheet are pulled
+        with a single batchGet. Returns a Snapshot.SheetSnapshot for each
+        entry, in the order of entries.
+
+        In incremental mode only the rows below the cached row count are
+        requested and merged into the cached snapshot. Passing full forces
+        a complete download of every entry.
+
+        Spreadsheets are fetched concurrently. One that has not finished
+        timeout seconds after it started is given up: its previous snapshot
+        is returned and whatever the fetch gets later is dropped.
+        '''
+        groups = {}
+        for x in range(0, len(entries)):
+            sheetNames = groups.setdefault(getSheetID(entries[x][0]), [])
+            if entries[x][1] not in sheetNames:
+                sheetNames.append(entries[x][1])
+
+        jobs = []
+        for spreadsheetId, sheetNames in groups.items():
+            with self.lock:
+                job = self.inflight.get(spreadsheetId)
+                if job is None or not job.serves(sheetNames, full):
+                    if job is not None:
+                        # only one fetch at a time may change the snapshots
+                        job.abandoned = True
+                    job = FetchJob(sheetNames, full)
+                    job.future = self.executor.submit(self.timedFetch, job,
+                                                      spreadsheetId)
+                    self.inflight[spreadsheetId] = job
+            jobs.append((spreadsheetId, job))
+        for spreadsheetId, job in jobs:
+            self.wait(spreadsheetId, job)
+
+        data = [None] * len(entries)
+        for x in range(0, len(entries)):
+            values = self.snapshots.get(
+                (getSheetID(entries[x][0]), entries[x][1]))
+            if not values:
+                print('No data found.')
+            else:
+                data[x] = values
+        return data
+
+    def timedFetch(self, job, spreadsheetId):
+        with self.lock:
+            if job.abandoned:
+                return
+            job.started = time.time()
+        self.fetchSpreadsheet(spreadsheetId, job.sheetNames, job.full, job)
+
+    def wait(self, spreadsheetId, job):
+        '''Waits for a fetch until timeout seconds after it started, then
+        abandons it unless its values are already in. Errors raised by the
+        fetch are passed on.'''
+        while True:
+            if job.started is not None:
+                remaining = job.started + self.timeout - time.time()
+            else:
+                remaining = self.timeout
+            try:
+                return job.future.result(max(remaining, 0))
+            except concurrent.futures.TimeoutError:
+                if job.started is not None and \
+                        time.time() >= job.started + self.timeout:
+                    with self.lock:
+                        if job.applied:
+                            # only the cache is still being written
+                            return
+                        job.abandoned = True
+                        if self.inflight.get(spreadsheetId) is job:
+                            del self.inflight[spreadsheetId]
+                    print('Timed out fetching', spreadsheetId,
+                          '- using the previous data')
+                    return
+
+    def fetchSpreadsheet(self, spreadsheetId, sheetNames, full=False,
+                         job=None):
+        '''Updates the cached snapshots of the given tabs of one spreadsheet
+        with a single batchGet, plus one more for any tab whose tail did
+        not line up with the cache. Everything is fetched before any
+        snapshot is changed, and nothing is changed if job was abandoned
+        meanwhile.'''
+        version = None
+        if self.cache_dir is not None and not full:
+            self.loadCache(spreadsheetId, sheetNames)
+        if not full:
+            version = self.getVersion(spreadsheetId)
+            if (version is not None and
+                    self.versions.get(spreadsheetId) == version and
+                    self.hasSnapshots(spreadsheetId, sheetNames)):
+                with self.lock:
+                    self.skipped_fetches += len(sheetNames)
+                return
+
+        ranges = []
+        tails = []
+        for sheetName in sheetNames:
+            if not full and self.canTail((spreadsheetId, sheetName)):
+                snapshot = self.snapshots[(spreadsheetId, sheetName)]
+                ranges.append(tailRange(sheetName, len(snapshot)))
+                tails.append(sheetName)
+            else:
+                ranges.append(sheetName)
+
+        refresh = []
+        # new snapshots and rows to append, by key
+        replaced = {}
+        appended = {}
+        valueRanges = self.batchGet(spreadsheetId, ranges)
+        for x in range(0, len(sheetNames)):
+            key = (spreadsheetId, sheetNames[x])
+            values = valueRanges[x].get('values', [])
+            if sheetNames[x] not in tails:
+                replaced[key] = Snapshot.SheetSnapshot(values)
+            elif self.tailMatches(key, values):
+                appended[key] = values[1:]
+            else:
+                refresh.append(sheetNames[x])
+
+        if refresh:
+            valueRanges = self.batchGet(spreadsheetId, refresh)
+            for x in range(0, len(refresh)):
+                key = (spreadsheetId, refresh[x])
+                replaced[key] = Snapshot.SheetSnapshot(
+                    valueRanges[x].get('values', []))
+
+        with self.lock:
+            if job is not None and job.abandoned:
+                print('Dropping the late fetch of', spreadsheetId)
+                return
+            for key in replaced:
+                self.snapshots[key] = replaced[key]
+                self.polls[key] = 0
+            for key in appended:
+                if appended[key]:
+                    self.snapshots[key].append(appended[key])
+                self.polls[key] = self.polls.get(key, 0) + 1
+            # only remembered once the values for it were actually stored
+            self.versions[spreadsheetId] = version
+            if job is not None:
+                job.applied = True
+        if self.cache_dir is not None:
+            self.saveCache(spreadsheetId, sheetNames, version)
+
+    def cachePath(self, key):
+        name = hashlib.sha1((key[0] + '\n' + key[1]).encode('utf-8'))
+        return os.path.join(self.cache_dir, name.hexdigest() + '.snap')
+
+    def versionPath(self, spreadsheetId):
+        name = hashlib.sha1(spreadsheetId.encode('utf-8'))
+        return os.path.join(self.cache_dir, name.hexdigest() + '.version')
+
+    def loadCache(self, spreadsheetId, sheetNames):
+        '''On the first fetch of a spreadsheet, loads the snapshots an
+        earlier run saved for it. If every tab was saved at the Drive
+        version last saved for the spreadsheet that version is restored
+        too, so an unchanged spreadsheet is not fetched at all.'''
+        if spreadsheetId in self.versions:
+            return
+        loaded = 0
+        for sheetName in sheetNames:
+            key = (spreadsheetId, sheetName)
+            if key in self.snapshots:
+                continue
+            snapshot, meta = Snapshot.load(self.cachePath(key))
+            if snapshot is None:
+                continue
+            print('Loaded', len(snapshot), 'cached rows of', sheetName)
+            self.snapshots[key] = snapshot
+            self.polls[key] = 0
+            self.saved[key] = (snapshot.generation, snapshot.version)
+            loaded += 1
+        try:
+            with open(self.versionPath(spreadsheetId)) as versionfile:
+                saved = json.load(versionfile)
+            version, sheets = saved['version'], sorted(saved['sheets'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return
+        if loaded == len(sheetNames) and set(sheetNames) <= set(sheets):
+            self.versions[spreadsheetId] = version
+            self.saved_versions[spreadsheetId] = (version, sheets)
+
+    def saveCache(self, spreadsheetId, sheetNames, version):
+        '''Saves the snapshots of the given tabs that changed since they
+        were last saved, then the Drive version they match. A new Drive
+        version alone does not write a tab again.'''
+        saved = []
+        for sheetName in sheetNames:
+            key = (spreadsheetId, sheetName)
+            snapshot = self.snapshots.get(key)
+            if snapshot is None:
+                continue
+            state = (snapshot.generation, snapshot.version)
+            if self.saved.get(key) != state:
+                try:
+                    snapshot.save(self.cachePath(key))
+                    self.saved[key] = state
+                except (IOError, OSError) as error:
+                    print('Could not cache', sheetName, error)
+                    continue
+            saved.append(sheetName)
+        # written after the tabs, and only naming the tabs that were saved,
+        # so it never vouches for a tab file older than version
+        state = (version, sorted(saved))
+        if self.saved_versions.get(spreadsheetId) == state:
+            return
+        path = self.versionPath(spreadsheetId)
+        try:
+            with open(path + '.tmp', 'w') as versionfile:
+                json.dump({'version': version, 'sheets': state[1]},
+                          versionfile)
+            os.replace(path + '.tmp', path)
+            self.saved_versions[spreadsheetId] = state
+        except (IOError, OSError) as error:
+            print('Could not cache the version of', spreadsheetId, error)
+
+    def getVersion(self, spreadsheetId):
+        '''Returns the Drive version of the spreadsheet, or None when no
+        Drive client is set or the lookup fails'''
+        if self.drive is None:
+            return None
+        try:
+            return self.drive.getVersion(spreadsheetId)
+        except Exception as error:
+            print('Could not get version of', spreadsheetId, error)
+            return None
+
+    def hasSnapshots(self, spreadsheetId, sheetNames):
+        for sheetName in sheetNames:
+            if (spreadsheetId, sheetName) not in self.snapshots:
+                return False
+        return True
+
+    def batchGet(self, spreadsheetId, ranges):
+        service = self.getService()
+        self.limiter.acquire('sheets', 'values.batchGet')
+        result = service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheetId, ranges=ranges).execute()
+        return result.get('valueRanges', [])
+
+    def canTail(self, key):
+        '''Whether key can be polled by fetching only its new rows'''
+        if not self.incremental or not self.snapshots.get(key):
+            return False
+        if '!' in key[1]:
+            # the title is already an explicit range
+            return False
+        if self.polls.get(key, 0) >= self.full_refresh_every:
+            # periodic full refresh catches edits above the watermark
+            return False
+        return True
+
+    def tailMatches(self, key, tail):
+        '''Whether the rows of tail can be appended to the snapshot of key.
+        tail starts at the last cached row, which must be unchanged;
+        otherwise rows were edited or deleted and the caller refreshes.
+        '''
+        snapshot = self.snapshots[key]
+        if not tail or tail[0] != snapshot[len(snapshot) - 1]:
+            print('Sheet', key[1], 'changed above row', len(snapshot),
+                  '- refreshing')
+            return False
+        return True
+
+
+def getData(url, sheetName, credfile=CLIENT_SECRET_FILE):
+    '''One-off fetch. Long running callers should keep a SheetsClient
+    instead so the service is not rebuilt on every call.
     '''
-    credentials = get_credentials(credfile)
-    http = credentials.authorize(httplib2.Http())
-    discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                    'version=v4')
-    service = discovery.build('sheets', 'v4', http=http,
-                              discoveryServiceUrl=discoveryUrl)
-
-    # '1OffNJpwb_Tw6zn6uf4ThWDmeWE8DL1kwF7IHaRPE9YU'
-    spreadsheetId = getSheetID(url)
-    rangeName = sheetName
-    result = service.spreadsheets().values().get(
-        spreadsheetId=spreadsheetId, range=rangeName).execute()
-    values = result.get('values', [])
-
-    if not values:
-        print('No data found.')
-    else:
-        return values
+    return SheetsClient(credfile).getData(url, sheetName)
@@ -0,0 +1,212 @@
+from __future__ import print_function
+import time
+import json
+import random
+import sqlite3
+import threading
+
+# seconds before the first retry of a failed email, doubled on every
+# further failure up to MAX_DELAY
+RETRY_DELAY = 2
+MAX_DELAY = 600
+MAX_ATTEMPTS = 8
+# delivered and failed emails are kept this many seconds, then deleted
+KEEP_DELIVERED = 7 * 24 * 60 * 60
+# delivery keys are kept this many seconds. Trigger state stops a trigger
+# from going back further than that.
+KEEP_KEYS = 30 * 24 * 60 * 60
+COMPACT_EVERY = 60 * 60
+
+
+class Outbox:
+    '''SQLite store of the emails to send.
+
+    Every email is written to the outbox before it is sent and stays
+    pending until Gmail accepts it. Emails that fail with a rate limit or
+    server error are tried again after a jittered exponential backoff, up
+    to max_attempts times; other failures are marked failed. Emails that
+    were being sent when the program stopped are pending again the next
+    time the outbox is opened.
+
+    Messages are (sender, to, subject, msgHtml, msgPlain, attachmentFile)
+    tuples, as taken by GMail.GmailSender.SendBatch. The outbox can be used
+    from several threads.
+
+    The outbox also keeps the delivery ledger: the key of every email that
+    was queued, such as group, trigger and row, so the same email is never
+    queued twice, even across restarts. Keys are looked up in memory and
+    dropped after KEEP_KEYS. Next to it is the state of every trigger, saved
+    in the same transaction as the emails it queued.
+    '''
+
+    def __init__(self, path, retry_delay=RETRY_DELAY, max_delay=MAX_DELAY,
+                 max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY, '
+                'created REAL, '
+                'message TEXT, '
+                "status TEXT DEFAULT 'pending', "
+                'attempts INTEGER DEFAULT 0, '
+                'next_attempt REAL, '
+                'sent REAL, '
+                'message_id TEXT, '
+                'error TEXT)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS pending '
+                'ON messages (status, next_attempt)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ledger ('
+                'key TEXT PRIMARY KEY, created REAL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS triggers ('
+                'name TEXT PRIMARY KEY, state TEXT)')
+            resumed = self.connection.execute(
+                "UPDATE messages SET status = 'pending' "
+                "WHERE status = 'sending'").rowcount
+        if resumed:
+            print('Outbox: resuming', resumed, 'interrupted emails')
+        self.keys = set()
+        self.compacted = 0
+        self.compact()
+        with self.lock:
+            self.keys.update(row[0] for row in self.connection.execute(
+                'SELECT key FROM ledger'))
+
+    def add(self, messages, keys=(), states=None):
+        '''Stores messages as pending, the delivery keys of the emails they
+        are and states, a dict of trigger name to json state, in one
+        transaction. Returns the ids of the messages.'''
+        now = time.time()
+        ids = []
+        with self.lock, self.connection:
+            for message in messages:
+                ids.append(self.connection.execute(
+                    'INSERT INTO messages (created, message, next_attempt) '
+                    'VALUES (?, ?, ?)',
+                    (now, json.dumps(message), now)).lastrowid)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO ledger (key, created) VALUES (?, ?)',
+                [(key, now) for key in keys])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO triggers (name, state) VALUES (?, ?)',
+                [(name, json.dumps(states[name])) for name in states or ()])
+        return ids
+
+    def reserve(self, key):
+        '''Claims a delivery key. Returns False if an email with that key
+        was already queued. The key is saved by the add it is passed to.'''
+        with self.lock:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            return True
+
+    def state(self, name):
+        '''Returns the saved state of a trigger, or None'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT state FROM triggers WHERE name = ?',
+                (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def compact(self, force=False):
+        '''Deletes emails delivered more than KEEP_DELIVERED ago, failed
+        emails created more than KEEP_DELIVERED ago and delivery keys older
+        than KEEP_KEYS, at most once every COMPACT_EVERY seconds unless
+        forced'''
+        now = time.time()
+        if not force and now - self.compacted < COMPACT_EVERY:
+            return
+        self.compacted = now
+        with self.lock, self.connection:
+            # failed emails have no send time, and give up within minutes
+            # of being created
+            self.connection.execute(
+                "DELETE FROM messages WHERE (status = 'delivered' AND "
+                "sent < ?) OR (status = 'failed' AND created < ?)",
+                (now - KEEP_DELIVERED, now - KEEP_DELIVERED))
+            old = [row[0] for row in self.connection.execute(
+                'SELECT key FROM ledger WHERE created < ?',
+                (now - KEEP_KEYS,))]
+            self.connection.executemany('DELETE FROM ledger WHERE key = ?',
+                                        [(key,) for key in old])
+            self.keys.difference_update(old)
+
+    def claim(self, limit, now=None):
+        '''Marks up to limit pending emails that are due as being sent and
+        returns them as (id, message) pairs, oldest first'''
+        if now is None:
+            now = time.time()
+        if limit <= 0:
+            return []
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT id, message FROM messages WHERE status = 'pending' "
+                'AND next_attempt <= ? ORDER BY id LIMIT ?',
+                (now, limit)).fetchall()
+            self.connection.executemany(
+                "UPDATE messages SET status = 'sending' WHERE id = ?",
+                [(row[0],) for row in rows])
+        return [(row[0], tuple(json.loads(row[1]))) for row in rows]
+
+    def release(self, ids):
+        '''Makes claimed emails that were not sent pending again'''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE messages SET status = 'pending' "
+                "WHERE id = ? AND status = 'sending'", [(id,) for id in ids])
+
+    def delivered(self, id, message_id=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE messages SET status = 'delivered', sent = ?, "
+                'message_id = ?, attempts = attempts + 1, error = NULL '
+                'WHERE id = ?', (time.time(), message_id, id))
+
+    def failed(self, id, error, retry):
+        '''Records a failed send. The email is scheduled again if retry is
+        true and it has attempts left, otherwise it is marked failed.'''
+        with self.lock, self.connection:
+            attempts = self.connection.execute(
+                'SELECT attempts FROM messages WHERE id = ?',
+                (id,)).fetchone()[0] + 1
+            if retry and attempts < self.max_attempts:
+                delay = min(self.retry_delay * 2 ** (attempts - 1),
+                            self.max_delay)
+                delay *= self.random.uniform(0.5, 1.5)
+                self.connection.execute(
+                    "UPDATE messages SET status = 'pending', attempts = ?, "
+                    'next_attempt = ?, error = ? WHERE id = ?',
+                    (attempts, time.time() + delay, str(error), id))
+            else:
+                self.connection.execute(
+                    "UPDATE messages SET status = 'failed', attempts = ?, "
+                    'error = ? WHERE id = ?', (attempts, str(error), id))
+                print('Email', id, 'could not be sent:', error)
+
+    def next_attempt(self):
+        '''Time of the earliest pending email, or None'''
+        with self.lock:
+            return self.connection.execute(
+                "SELECT MIN(next_attempt) FROM messages "
+                "WHERE status = 'pending'").fetchone()[0]
+
+    def counts(self):
+        '''Returns the number of emails in each status'''
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT status, COUNT(*) FROM messages GROUP BY status'))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,114 @@
+from __future__ import print_function
+import time
+import threading
+
+# (requests or quota units per second, burst) for each api, from the
+# per user quotas of the Google APIs
+LIMITS = {
+    # 60 read requests per minute per user
+    'sheets': (1.0, 10),
+    # 250 quota units per second per user
+    'gmail': (250.0, 250),
+    # 12000 requests per minute per user
+    'drive': (200.0, 100),
+}
+# quota units taken by one call, where a call costs more than one
+COSTS = {
+    ('gmail', 'messages.send'): 100,
+}
+
+
+class TokenBucket:
+    '''Allows rate tokens per second with bursts of up to burst tokens.
+
+    A caller that takes more tokens than are left waits until they have
+    been refilled. Tokens are taken before waiting, so callers are served
+    in the order they asked and a cost larger than burst still gets
+    through at the average rate.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        '''Takes cost tokens and returns how many seconds the caller has to
+        wait before using them'''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    '''Token buckets for each api, and for single methods of an api that
+    have their own limit.
+
+    Every request calls acquire with its api and method, e.g. 'sheets' and
+    'values.batchGet', which waits until both the api bucket and the method
+    bucket, if there is one, allow it. How long requests waited is kept for
+    each api and method.
+    '''
+
+    def __init__(self, limits=LIMITS, costs=COSTS):
+        self.buckets = {}
+        self.costs = dict(costs)
+        self.lock = threading.Lock()
+        self.waits = {}
+        for api in limits:
+            self.configure(api, None, *limits[api])
+
+    def configure(self, api, method, rate, burst):
+        '''Limits api, or one method of it when method is not None, to
+        rate per second with bursts of up to burst. A rate of None removes
+        the limit.'''
+        with self.lock:
+            if rate is None:
+                self.buckets.pop((api, method), None)
+            else:
+                self.buckets[(api, method)] = TokenBucket(rate, burst)
+
+    def acquire(self, api, method, count=1):
+        '''Waits until count calls to method of api are allowed. Returns
+        the number of seconds waited.'''
+        cost = self.costs.get((api, method), 1) * count
+        delay = 0.0
+        for key in ((api, None), (api, method)):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                delay = max(delay, bucket.reserve(cost))
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            calls, total, longest = self.waits.get((api, method),
+                                                   (0, 0.0, 0.0))
+            self.waits[(api, method)] = (calls + count, total + delay,
+                                         max(longest, delay))
+        return delay
+
+    def stats(self):
+        '''Returns {(api, method): (calls, seconds waited, longest wait)}'''
+        with self.lock:
+            return dict(self.waits)
+
+    def summary(self):
+        '''Returns a printable line per method that had to wait'''
+        lines = []
+        for key, (calls, total, longest) in sorted(self.stats().items()):
+            if total:
+                lines.append('%-24s %6d calls, %7.2fs waited, %5.2fs longest'
+                             % ('.'.join(key), calls, total, longest))
+        return '\n'.join(lines)
+
+
+# the limiter used by the GSheet, GMail and GDrive clients unless they are
+# given their own
+shared = RateLimiter()
@@ -0,0 +1,70 @@
+from __future__ import print_function
+import time
+
+
+class PollScheduler:
+    '''Decides when each watched sheet should be polled next.
+
+    Every sheet starts at start_interval seconds. When a poll finds new rows
+    the interval is divided by backoff so bursts are followed closely, and
+    when it finds nothing the interval is multiplied by backoff. Intervals
+    stay between min_interval and max_interval, and the lower bound is
+    raised so that polling all watched sheets stays within quota requests
+    per minute.
+    '''
+
+    def __init__(self, min_interval=5, max_interval=300, start_interval=10,
+                 backoff=2.0, quota=60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.start_interval = start_interval
+        self.backoff = backoff
+        self.quota = quota
+        # sheet index -> [interval, next poll time, row count]
+        self.sheets = {}
+
+    def watch(self, sheet, now=None):
+        '''Starts scheduling sheet, polling it right away'''
+        if sheet not in self.sheets:
+            if now is None:
+                now = time.time()
+            self.sheets[sheet] = [self.start_interval, now, None]
+
+    def floor(self):
+        '''Shortest interval allowed by min_interval and the quota'''
+        if not self.quota:
+            return self.min_interval
+        return max(self.min_interval, len(self.sheets) * 60.0 / self.quota)
+
+    def due(self, now=None):
+        '''Returns the watched sheets whose poll time has come'''
+        if now is None:
+            now = time.time()
+        return [sheet for sheet in sorted(self.sheets)
+                if self.sheets[sheet][1] <= now]
+
+    def record(self, sheet, rows, now=None):
+        '''Adjusts the interval of sheet after a poll that found rows rows
+        and schedules its next poll. Returns whether the sheet changed.'''
+        if now is None:
+            now = time.time()
+        state = self.sheets[sheet]
+        changed = state[2] is not None and rows != state[2]
+        if changed:
+            state[0] = state[0] / self.backoff
+        elif state[2] is not None:
+            state[0] = state[0] * self.backoff
+        state[0] = min(max(state[0], self.floor()), self.max_interval)
+        state[1] = now + state[0]
+        state[2] = rows
+        return changed
+
+    def next_wake(self, wakeups=(), now=None):
+        '''Seconds until the next sheet poll or the earliest of wakeups,
+        which are absolute times such as TimeInterval due times'''
+        if now is None:
+            now = time.time()
+        times = [state[1] for state in self.sheets.values()] + list(wakeups)
+        if not times:
+            return self.max_interval
+        return min(max(min(times) - now, 0), self.max_interval)
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import time
+import queue
+import threading
+
+# seconds stop waits for the batches being sent
+STOP_TIMEOUT = 5
+
+
+class SendQueue:
+    '''Sends rendered emails on background threads.
+
+    put adds an email claimed from outbox to a bounded queue. Each worker
+    takes whatever is waiting, up to transport.batch_size emails, sends it
+    with the transport (see Transport.py), so a slow send never holds up
+    the poll loop, and records in the outbox whether each email was
+    delivered. Failed emails
+    are retried by the outbox rather than here. stats reports the queue
+    depth and how long emails waited between put and being sent.
+    '''
+
+    def __init__(self, transport, outbox, workers=2, maxsize=1000):
+        self.transport = transport
+        self.outbox = outbox
+        self.batch_size = transport.batch_size
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.workers = []
+        for x in range(0, workers):
+            worker = threading.Thread(target=self.work,
+                                      name='SendQueue-' + str(x + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, id, message):
+        '''Queues the outbox email id without waiting. Returns False if the
+        queue is full.'''
+        try:
+            self.queue.put_nowait((time.time(), id, message))
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def space(self):
+        '''Number of emails that can be put without the queue being full'''
+        return self.queue.maxsize - self.queue.qsize()
+
+    def work(self):
+        while True:
+            items = [self.queue.get()]
+            while items[len(items) - 1] is not None and \
+                    len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[len(items) - 1] is None
+            if stop:
+                items.pop()
+            if items:
+                self.send(items)
+            for x in range(0, len(items) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def send(self, items):
+        failures = {}
+        try:
+            results = self.transport.send([item[2] for item in items],
+                                          failures)
+        except Exception as error:
+            print('Send failed: %s' % error)
+            results = ['Error'] * len(items)
+            failures = dict.fromkeys(range(0, len(items)), error)
+        for x in range(0, len(items)):
+            if results[x] == 'Error':
+                self.outbox.failed(items[x][1], failures[x],
+                                   self.transport.isRetryable(failures[x]))
+            else:
+                self.outbox.delivered(items[x][1], results[x].get('id'))
+        now = time.time()
+        with self.lock:
+            for x in range(0, len(items)):
+                if results[x] == 'Error':
+                    self.failed += 1
+                else:
+                    self.sent += 1
+                waited = now - items[x][0]
+                self.latency_total += waited
+                self.latency_max = max(self.latency_max, waited)
+
+    def stats(self):
+        '''Returns the queue depth, messages sent and failed, and the mean
+        and longest seconds from put to sent'''
+        with self.lock:
+            done = self.sent + self.failed
+            return {'depth': self.depth(),
+                    'sent': self.sent,
+                    'failed': self.failed,
+                    'latency_avg': self.latency_total / done if done else 0.0,
+                    'latency_max': self.latency_max}
+
+    def stop(self, wait=True, timeout=STOP_TIMEOUT):
+        '''Stops the workers once they have sent the batch they are on.
+        Emails still waiting in the queue are handed back to the outbox,
+        which sends them on the next run. With wait, waits up to timeout
+        seconds for the workers to exit.'''
+        waiting = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            if item is not None:
+                waiting.append(item[1])
+        if waiting:
+            self.outbox.release(waiting)
+        for worker in self.workers:
+            self.queue.put(None)
+        if wait:
+            deadline = time.time() + timeout
+            for worker in self.workers:
+                worker.join(max(deadline - time.time(), 0))
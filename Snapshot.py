@@ -0,0 +1,481 @@
+from __future__ import print_function
+import os
+import sys
+import math
+import mmap
+import json
+import struct
+import itertools
+import bisect
+import datetime
+import collections
+from array import array
+
+from dateutil import parser
+
+# cache files start with MAGIC and a little endian format number and
+# header length, followed by a json header and the column data
+MAGIC = b'F2ESNAP'
+FORMAT = 1
+
+# how Google Forms and ISO 8601 write times, tried before dateutil
+TIME_FORMATS = ('%m/%d/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S', '%m/%d/%Y')
+
+# every snapshot gets a new generation, so a replaced sheet is never
+# mistaken for the one it replaced
+generations = itertools.count(1)
+
+
+class Column:
+    '''One column of a sheet below the header row.
+
+    Cells are kept as an array of 64 bit integers or doubles while every
+    value in the column is written the way Python writes that number, so
+    converting back gives the original text. Otherwise the column is a list
+    of interned strings.
+    '''
+
+    def __init__(self, count=0):
+        if count:
+            self.kind = 'text'
+            self.values = [''] * count
+        else:
+            self.kind = None
+            self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        if self.kind is None:
+            self.kind = numberKind(value)
+            if self.kind == 'int':
+                self.values = array('q')
+            elif self.kind == 'float':
+                self.values = array('d')
+        if self.kind == 'int':
+            if numberKind(value) == 'int':
+                self.values.append(int(value))
+                return
+            self.toText()
+        elif self.kind == 'float':
+            if numberKind(value) == 'float':
+                self.values.append(float(value))
+                return
+            self.toText()
+        self.values.append(sys.intern(value))
+
+    def toText(self):
+        '''Turns a numeric column into a text column'''
+        if self.kind == 'int':
+            self.values = [sys.intern(str(x)) for x in self.values]
+        elif self.kind == 'float':
+            self.values = [sys.intern(repr(x)) for x in self.values]
+        self.kind = 'text'
+
+    def text(self, value):
+        '''Returns a stored value as the text it was read from'''
+        if self.kind == 'int':
+            return str(value)
+        elif self.kind == 'float':
+            return repr(value)
+        return value
+
+    def get(self, index):
+        return self.text(self.values[index])
+
+    def slice(self, start, stop):
+        '''Returns the stored values of rows start to stop as they are
+        stored: numbers for numeric columns, strings otherwise'''
+        return self.values[start:stop]
+
+
+def numberKind(value):
+    '''Returns 'int' or 'float' if value is a number written exactly the
+    way Python would write it, otherwise 'text' '''
+    try:
+        if str(int(value)) == value and -2 ** 63 <= int(value) < 2 ** 63:
+            return 'int'
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+        if math.isfinite(number) and repr(number) == value:
+            return 'float'
+    except ValueError:
+        pass
+    return 'text'
+
+
+class SheetSnapshot:
+    '''Column-wise store of the values of one sheet.
+
+    The first row (the form's questions) is kept as a plain list and every
+    other row is split over Columns. Row count is O(1), rows can be appended
+    cheaply and whole columns can be read without building rows.
+
+    A snapshot still reads like the list of rows returned by the Sheets API:
+    len(snapshot), snapshot[row] and snapshot[row][column] behave the same,
+    rows included, including rows shorter than the header.
+    '''
+
+    def __init__(self, rows=()):
+        self.header = None
+        self.columns = []
+        self.widths = array('I')
+        self.generation = next(generations)
+        self.version = 0
+        self.append(rows)
+
+    def __len__(self):
+        if self.header is None:
+            return 0
+        return len(self.widths) + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row(x) for x in range(*index.indices(len(self)))]
+        return self.row(index)
+
+    def __iter__(self):
+        for x in range(0, len(self)):
+            yield self.row(x)
+
+    def append(self, rows):
+        '''Appends rows, lists of strings as returned by the Sheets API.
+        The version only changes if there were rows to add.'''
+        added = False
+        for row in rows:
+            added = True
+            if self.header is None:
+                self.header = [sys.intern(x) for x in row]
+                continue
+            count = len(self.widths)
+            while len(self.columns) < len(row):
+                self.columns.append(Column(count))
+            for x in range(0, len(self.columns)):
+                if x < len(row):
+                    self.columns[x].append(row[x])
+                else:
+                    self.columns[x].append('')
+            self.widths.append(len(row))
+        if added:
+            self.version += 1
+
+    def index(self, row):
+        '''Turns a row number that may be negative into one from 0'''
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError('row index out of range')
+        return row
+
+    def row(self, row):
+        '''Returns a row as a list of strings'''
+        row = self.index(row)
+        if row == 0:
+            return list(self.header)
+        row -= 1
+        return [self.columns[x].get(row)
+                for x in range(0, self.widths[row])]
+
+    def cell(self, row, column):
+        '''Returns snapshot[row][column] without building the row'''
+        row = self.index(row)
+        if row == 0:
+            return self.header[column]
+        width = self.widths[row - 1]
+        if column < 0:
+            column += width
+        if column < 0 or column >= width:
+            raise IndexError('list index out of range')
+        return self.columns[column].get(row - 1)
+
+    def column(self, column, start=0, stop=None):
+        '''Returns the cells of column for rows start up to stop as
+        strings. Rows too short to have the column give '' and a negative
+        column counts from the end of each row.'''
+        if stop is None:
+            stop = len(self)
+        if (column < 0 or start < 0 or stop > len(self) or
+                column >= len(self.columns)):
+            cells = []
+            for x in range(start, stop):
+                try:
+                    cells.append(self.cell(x, column))
+                except IndexError:
+                    cells.append('')
+            return cells
+        cells = []
+        if start == 0 and stop > 0:
+            cells.append(self.header[column]
+                         if column < len(self.header) else '')
+            start = 1
+        if start < stop:
+            values = self.columns[column].slice(start - 1, stop - 1)
+            if self.columns[column].kind == 'text':
+                cells.extend(values)
+            else:
+                cells.extend([self.columns[column].text(x) for x in values])
+        return cells
+
+    def counts(self, column, start=0, stop=None):
+        '''Returns a Counter of the cells column(column, start, stop) would
+        return, in the order they first appear. Numeric columns are counted
+        as stored and each distinct number is turned into text once.'''
+        if stop is None:
+            stop = len(self)
+        if (column < 0 or start < 0 or stop > len(self) or
+                column >= len(self.columns)):
+            return collections.Counter(self.column(column, start, stop))
+        counts = collections.Counter()
+        if start == 0 and stop > 0:
+            counts[self.header[column]
+                   if column < len(self.header) else ''] += 1
+            start = 1
+        if start < stop:
+            stored = self.columns[column]
+            values = collections.Counter(stored.slice(start - 1, stop - 1))
+            if stored.kind == 'text':
+                counts.update(values)
+            else:
+                for value, count in values.items():
+                    counts[stored.text(value)] += count
+        return counts
+
+    def rows(self):
+        '''Returns every row as a list of lists'''
+        return [self.row(x) for x in range(0, len(self))]
+
+    def save(self, path, meta=None):
+        '''Writes the snapshot to path in the cache format read by load.
+        meta is any json data to keep with it. The file is replaced
+        atomically so a crash never leaves a half written cache.'''
+        blocks = [self.widths.tobytes()]
+        columns = []
+        for column in self.columns:
+            if column.kind in ('int', 'float'):
+                columns.append({'kind': column.kind})
+                blocks.append(column.values.tobytes())
+                continue
+            # text columns are stored as their distinct values plus one
+            # index per row, which is small for multiple choice answers
+            codes = {}
+            indexes = array('I')
+            for value in column.values:
+                indexes.append(codes.setdefault(value, len(codes)))
+            encoded = [value.encode('utf-8') for value in codes]
+            offsets = array('Q', [0])
+            for value in encoded:
+                offsets.append(offsets[len(offsets) - 1] + len(value))
+            columns.append({'kind': 'text', 'distinct': len(encoded)})
+            blocks += [offsets.tobytes(), indexes.tobytes(),
+                       b''.join(encoded)]
+
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'header': self.header,
+            'rows': len(self.widths),
+            'columns': columns,
+            'sizes': [len(block) for block in blocks],
+            'meta': meta}).encode('utf-8')
+        temp = path + '.tmp'
+        with open(temp, 'wb') as savefile:
+            savefile.write(MAGIC + struct.pack('<II', FORMAT, len(header)))
+            savefile.write(header)
+            for block in blocks:
+                savefile.write(block)
+        os.replace(temp, path)
+
+
+class RunningCounts:
+    '''Counts of the cells of one column from row start to the end of a
+    sheet, kept up to date as rows are appended.
+
+    update counts only the rows added since it was last called. A snapshot
+    of another generation, which means the sheet was fetched again because
+    rows were edited or deleted, is counted again from start.
+    '''
+
+    def __init__(self, column, start):
+        self.column = column
+        self.start = start
+        self.generation = None
+        # rows before stop have been counted
+        self.stop = start
+        self.counts = collections.Counter()
+
+    def update(self, snapshot):
+        '''Counts the rows added to snapshot and returns the Counter'''
+        stop = len(snapshot)
+        if snapshot.generation != self.generation or stop < self.stop:
+            self.generation = snapshot.generation
+            self.stop = self.start
+            self.counts = collections.Counter()
+        if stop > self.stop:
+            self.counts.update(snapshot.counts(self.column, self.stop, stop))
+            self.stop = stop
+        return self.counts
+
+
+class TimestampIndex:
+    '''The times in the first column of a sheet, parsed once per row and
+    kept up to date as rows are appended like RunningCounts.
+
+    Form responses arrive in time order, so the rows after a time are
+    found by binary search. If the times are ever out of order they are
+    searched one by one, still without parsing them again.
+    '''
+
+    def __init__(self):
+        self.generation = None
+        # times[x] is the time of row x + 1, or None if it is not a time
+        self.times = []
+        self.ordered = True
+        # the format that parsed the last time
+        self.format = TIME_FORMATS[0]
+
+    def update(self, snapshot):
+        '''Parses the rows added to snapshot'''
+        stop = len(snapshot)
+        if (snapshot.generation != self.generation or
+                stop - 1 < len(self.times)):
+            self.generation = snapshot.generation
+            self.times = []
+            self.ordered = True
+        if stop - 1 > len(self.times):
+            for value in snapshot.column(0, len(self.times) + 1, stop):
+                time = self.parse(value)
+                if time is None or (self.times and (
+                        self.times[-1] is None or time < self.times[-1])):
+                    self.ordered = False
+                self.times.append(time)
+        return self
+
+    def parse(self, value):
+        '''Returns the time written in value, or None if it is not one'''
+        for format in (self.format,) + TIME_FORMATS:
+            try:
+                time = datetime.datetime.strptime(value, format)
+                self.format = format
+                return time
+            except ValueError:
+                pass
+        try:
+            return parser.parse(value)
+        except (ValueError, OverflowError):
+            return None
+
+    def after(self, time):
+        '''Returns the first and the last row later than time, like
+        Engine.time_statistics_command always has: -1 as the first row if
+        there is none and 0 as the last row unless there are two or more'''
+        if self.ordered:
+            first = bisect.bisect_right(self.times, time) + 1
+            last = len(self.times)
+        else:
+            rows = [x + 1 for x in range(0, len(self.times))
+                    if self.times[x] is not None and self.times[x] > time]
+            first, last = (rows[0], rows[-1]) if rows else (1, 0)
+        if first > last:
+            return -1, 0
+        if first == last:
+            return first, 0
+        return first, last
+
+
+def load(path):
+    '''Reads a snapshot written by SheetSnapshot.save. Returns the snapshot
+    and its meta data, or (None, None) if the file is missing, damaged or
+    not a cache file of this format.'''
+    try:
+        loadfile = open(path, 'rb')
+    except IOError:
+        return None, None
+    with loadfile:
+        try:
+            data = mmap.mmap(loadfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None, None
+        with data:
+            try:
+                return fromData(data)
+            except (ValueError, KeyError, IndexError, TypeError,
+                    struct.error) as error:
+                print('Ignoring cache file', path, '-', error)
+                return None, None
+
+
+def fromData(data):
+    '''Reads the snapshot and meta data in the bytes of a cache file,
+    raising ValueError if they do not hold together'''
+    start = len(MAGIC) + 8
+    if len(data) < start or data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a snapshot cache file')
+    version, length = struct.unpack('<II', data[len(MAGIC):start])
+    if version != FORMAT:
+        raise ValueError('cache format %d' % version)
+    if start + length > len(data):
+        raise ValueError('truncated header')
+    header = json.loads(data[start:start + length].decode('utf-8'))
+    sizes = header['sizes']
+    position = start + length
+    if (not all(isinstance(size, int) and size >= 0 for size in sizes) or
+            position + sum(sizes) != len(data)):
+        raise ValueError('blocks do not match the file length')
+    blocks = []
+    for size in sizes:
+        blocks.append(data[position:position + size])
+        position += size
+    return fromBlocks(header, blocks), header['meta']
+
+
+def fromBlocks(header, blocks):
+    swap = header['byteorder'] != sys.byteorder
+
+    def read(typecode, block):
+        values = array(typecode)
+        values.frombytes(block)
+        if swap:
+            values.byteswap()
+        return values
+
+    snapshot = SheetSnapshot()
+    snapshot.header = header['header']
+    if snapshot.header is not None:
+        snapshot.header = [sys.intern(x) for x in snapshot.header]
+    snapshot.widths = read('I', blocks[0])
+    position = 1
+    for info in header['columns']:
+        column = Column()
+        column.kind = info['kind']
+        if column.kind == 'int':
+            column.values = read('q', blocks[position])
+            position += 1
+        elif column.kind == 'float':
+            column.values = read('d', blocks[position])
+            position += 1
+        else:
+            offsets = read('Q', blocks[position])
+            indexes = read('I', blocks[position + 1])
+            text = blocks[position + 2]
+            if (len(offsets) != info['distinct'] + 1 or
+                    offsets[len(offsets) - 1] != len(text) or
+                    any(offsets[x] > offsets[x + 1]
+                        for x in range(0, info['distinct']))):
+                raise ValueError('bad text offsets')
+            distinct = [sys.intern(str(text[offsets[x]:offsets[x + 1]],
+                                       'utf-8'))
+                        for x in range(0, info['distinct'])]
+            column.values = [distinct[x] for x in indexes]
+            position += 3
+        snapshot.columns.append(column)
+    if position != len(blocks) or len(snapshot.widths) != header['rows'] or \
+            [x for x in snapshot.columns if len(x) != header['rows']]:
+        raise ValueError('row counts do not match')
+    if snapshot.widths and max(snapshot.widths) > len(snapshot.columns):
+        raise ValueError('rows wider than the columns')
+    snapshot.version = 1
+    return snapshot
@@ -0,0 +1,177 @@
+from __future__ import print_function
+
+
+class Command:
+    '''One \\\\ command of an email template, split into its fields.
+
+    \\\\stat\\option\\sheet\\column\\rows\\title,
+    \\\\time\\option\\sheet\\title and variables,
+    \\\\sheet\\column\\row, are told apart by the first field.
+    '''
+
+    def __init__(self, engine, text):
+        self.text = text
+        self.fields = (text.split('\\')[2:] + [''] * 6)[:6]
+        name = self.fields[0].lower()
+        if 'time' in name:
+            self.kind = 'time'
+        elif 'stat' in name:
+            self.kind = 'stat'
+        else:
+            self.kind = 'variable'
+            sheet, column, row = self.fields[:3]
+            self.sheet = int(sheet) - 1 if sheet.isdigit() else None
+            self.column = None
+            if column != '':
+                if not column.isdigit():
+                    column = engine.column_id_to_int(column)
+                self.column = int(column) - 1
+            self.row = row
+
+
+def parse(engine, html):
+    '''Splits a template into literal strings and Commands. A command
+    starts with \\\\ and ends at the first character that is not a
+    letter, digit, \\, - or :.'''
+    nodes = []
+    position = 0
+    while True:
+        first = html.find('\\\\', position)
+        if first == -1:
+            break
+        last = first
+        while last < len(html) and (html[last].isalnum() or
+                                    html[last] in '\\-:'):
+            last += 1
+        if first > position:
+            nodes.append(html[position:first])
+        nodes.append(Command(engine, html[first:last]))
+        position = last
+    if position < len(html):
+        nodes.append(html[position:])
+    return nodes
+
+
+class Template:
+    '''An email template parsed once into literal text and commands, so
+    every render is a single pass over the parts joined into one string.
+    Get templates from Engine.compile_template, which keeps them.
+
+    renderRows is used by MailMerge: it fills every variable without a row
+    with the cell of a given row of the merge sheet. \\\\stat and
+    \\\\time commands and variables that name their own row or another
+    sheet are the same for every row and are evaluated once.
+
+    A plain template, such as a subject, is filled with the text of the
+    cells as it is. Commands that would render as images, charts and
+    Drive links, give nothing.
+    '''
+
+    def __init__(self, engine, html, plain=False):
+        self.engine = engine
+        self.html = html
+        self.plain = plain
+        self.nodes = parse(engine, html)
+
+    def sheets(self):
+        '''Returns the indexes of the sheets the template reads'''
+        sheets = set()
+        for node in self.nodes:
+            if not isinstance(node, Command):
+                continue
+            if node.kind == 'variable':
+                if node.sheet is not None:
+                    sheets.add(node.sheet)
+            elif node.fields[2].isdigit():
+                sheets.add(int(node.fields[2]) - 1)
+        return sheets
+
+    def render(self, data, time=None):
+        '''Returns the html and the files to attach'''
+        html = []
+        attachments = []
+        for node in self.nodes:
+            text, attach = self.evaluate(node, data, None, time)
+            html.append(text)
+            attachments += attach or []
+        return ''.join(html), attachments
+
+    def shared(self, node, sheet):
+        '''Whether a node renders the same for every row of sheet'''
+        return not (isinstance(node, Command) and node.kind == 'variable' and
+                    node.row == '' and node.sheet == sheet)
+
+    def renderRows(self, data, sheet, rows, time=None):
+        '''Returns (html, attachments) for each row index in rows of
+        data[sheet]'''
+        parts = []
+        attachments = []
+        for node in self.nodes:
+            if not self.shared(node, sheet):
+                parts.append(node)
+                continue
+            text, attach = self.evaluate(node, data, None, time)
+            parts.append(text)
+            attachments += attach or []
+
+        rendered = []
+        for row in rows:
+            html = []
+            attach = list(attachments)
+            for part in parts:
+                if isinstance(part, Command):
+                    text, images = self.evaluate(part, data, row, time)
+                    html.append(text)
+                    attach += images or []
+                else:
+                    html.append(part)
+            rendered.append((''.join(html), attach))
+        return rendered
+
+    def evaluate(self, node, data, row, time):
+        '''Returns the text and attachments of a node. Variables without a
+        row read row, or the last row when row is None.'''
+        if not isinstance(node, Command):
+            return node, None
+        fields = node.fields
+        if node.kind in ('stat', 'time'):
+            if node.kind == 'stat':
+                text, attach = self.engine.statistics_command(
+                    data, fields[1], fields[2], fields[3], fields[4],
+                    fields[5])
+            else:
+                text, attach = self.engine.time_statistics_command(
+                    data, fields[1], fields[2], time, fields[3])
+            if self.plain and attach:
+                return '', None
+            return text, attach
+        if node.sheet is None or node.column is None:
+            return '', None
+        sheet = data[node.sheet]
+        if node.row != '':
+            try:
+                if node.row.startswith('-'):
+                    row = len(sheet) - int(node.row[1:]) - 1
+                else:
+                    row = int(node.row) - 1
+            except ValueError:
+                return '', None
+        elif row is None:
+            row = len(sheet) - 1
+        return self.cell(sheet, row, node.column)
+
+    def cell(self, sheet, row, column):
+        '''Renders the value of a cell: Drive links as images and answers
+        containing no in red'''
+        try:
+            value = str(sheet.cell(row, column))
+        except (IndexError, TypeError):
+            return '', None
+        if self.plain:
+            return value, None
+        images, attach = self.engine.create_images(value)
+        if images is not None:
+            return images, attach
+        if 'no' in value or 'No' in value:
+            value = '<span style="color: #ff0000;">' + value + '</span>'
+        return value, None
@@ -0,0 +1,307 @@
+'''
+Ways of delivering the emails Form2Email sends.
+
+A transport takes a list of (sender, to, subject, msgHtml, msgPlain,
+attachmentFile) tuples and delivers them. GmailTransport sends through the
+Gmail API and is the default. SMTPTransport sends through any SMTP relay
+over a pool of reused connections.
+
+To send through a relay set FORM2EMAIL_SMTP, e.g.
+    FORM2EMAIL_SMTP="host=smtp.example.com,port=587,starttls=1,
+                     user=forms,password=secret,sender=forms@example.com"
+
+Running this file benchmarks SMTPTransport against a local SMTP sink.
+'''
+
+from __future__ import print_function
+import os
+import time
+import queue
+import socket
+import smtplib
+import threading
+from email import utils
+
+import GMail
+import RateLimit
+
+# SMTP connections kept open for reuse
+POOL_SIZE = 4
+TIMEOUT = 30
+
+
+class Transport:
+    '''Interface of the transports'''
+
+    # emails handed to send at once
+    batch_size = 50
+
+    def send(self, messages, failures):
+        '''Sends messages. Returns one result per message, in order: a dict
+        whose 'id' identifies the sent email, or 'Error'. The error of every
+        email that could not be sent is stored in failures by index.'''
+        raise NotImplementedError
+
+    def isRetryable(self, error):
+        '''Whether an email that failed with error may be sent again'''
+        return False
+
+    def shutdown(self):
+        '''Releases what the transport holds open'''
+        pass
+
+
+class GmailTransport(Transport):
+    '''Sends through the Gmail API with a GMail.GmailSender'''
+
+    batch_size = GMail.BATCH_SIZE
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+
+    def send(self, messages, failures):
+        return self.mailer.SendBatch(messages, retries=0, failures=failures)
+
+    def isRetryable(self, error):
+        return GMail.isRetryable(error)
+
+
+class SMTPTransport(Transport):
+    '''Sends through an SMTP server.
+
+    Up to pool_size connections are kept open and reused, so a busy queue
+    pays for connecting, TLS and logging in once per connection rather than
+    once per email. Every sending thread takes a connection of its own.
+    The Gmail sender 'me' is replaced by sender. Temporary (4xx) replies and
+    dropped connections can be retried; other errors are final.
+    '''
+
+    batch_size = 20
+
+    def __init__(self, host='localhost', port=25, sender=None, user=None,
+                 password=None, starttls=False, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT, limiter=None):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.limiter = limiter if limiter is not None else RateLimit.shared
+        self.pool = queue.LifoQueue(pool_size)
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.ehlo()
+        if self.starttls:
+            connection.starttls()
+            connection.ehlo()
+        if self.user:
+            connection.login(self.user, self.password)
+        return connection
+
+    def take(self):
+        '''Returns a pooled connection, or a new one if none are free'''
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def give(self, connection):
+        '''Returns a connection to the pool, closing it if the pool is
+        full'''
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            self.close(connection)
+
+    def close(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def send(self, messages, failures):
+        results = ['Error'] * len(messages)
+        connection = None
+        for x in range(0, len(messages)):
+            sender, to, subject, msgHtml, msgPlain, attachmentFile = \
+                messages[x]
+            if sender == 'me' and self.sender:
+                sender = self.sender
+            try:
+                message = GMail.buildMessage(sender, to, subject, msgHtml,
+                                             msgPlain, attachmentFile)
+            except (IOError, OSError) as error:
+                print('An error occurred: %s' % error)
+                failures[x] = error
+                continue
+            message['Message-ID'] = utils.make_msgid()
+            self.limiter.acquire('smtp', 'send')
+            # a pooled connection may have been closed by the server while
+            # it was idle, so a dropped connection is tried once more
+            for attempt in range(0, 2):
+                dropped = None
+                try:
+                    if connection is None:
+                        connection = self.take()
+                    connection.send_message(message)
+                    results[x] = {'id': message['Message-ID']}
+                    print('Message Id: %s' % message['Message-ID'])
+                    break
+                except smtplib.SMTPServerDisconnected as error:
+                    dropped = error
+                except smtplib.SMTPException as error:
+                    # the server refused this email
+                    print('An error occurred: %s' % error)
+                    failures[x] = error
+                    break
+                except OSError as error:
+                    dropped = error
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if attempt == 1:
+                    print('An error occurred: %s' % dropped)
+                    failures[x] = dropped
+        if connection is not None:
+            self.give(connection)
+        return results
+
+    def isRetryable(self, error):
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500
+                       for code, reply in error.recipients.values())
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        # smtplib errors are OSErrors too, but only network errors are
+        # worth retrying
+        return (isinstance(error, OSError) and
+                not isinstance(error, smtplib.SMTPException))
+
+    def shutdown(self):
+        '''Closes the pooled connections'''
+        while True:
+            try:
+                self.close(self.pool.get_nowait())
+            except queue.Empty:
+                return
+
+
+def fromEnvironment(mailer):
+    '''Returns an SMTPTransport configured by FORM2EMAIL_SMTP, or a
+    GmailTransport sending with mailer when it is not set'''
+    setting = os.environ.get('FORM2EMAIL_SMTP')
+    if setting is None:
+        return GmailTransport(mailer)
+    options = {}
+    for item in setting.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            options[name.strip()] = value.strip()
+    for name in ('port', 'pool_size', 'timeout'):
+        if name in options:
+            options[name] = int(options[name])
+    if 'starttls' in options:
+        options['starttls'] = options['starttls'].lower() in ('1', 'true',
+                                                              'yes')
+    print('Sending through SMTP server', options.get('host', 'localhost'))
+    return SMTPTransport(**options)
+
+
+class SMTPSink:
+    '''Minimal SMTP server that accepts and counts every email, for
+    benchmarking SMTPTransport locally'''
+
+    def __init__(self, host='localhost', port=0):
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self.received = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            client, address = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, client):
+        with self.lock:
+            self.connections += 1
+        stream = client.makefile('rwb')
+        stream.write(b'220 sink ready\r\n')
+        stream.flush()
+        data = False
+        for line in stream:
+            if data:
+                if line == b'.\r\n':
+                    data = False
+                    with self.lock:
+                        self.received += 1
+                    stream.write(b'250 OK\r\n')
+                    stream.flush()
+                continue
+            command = line[:4].upper()
+            if command == b'EHLO':
+                stream.write(b'250-sink\r\n250 8BITMIME\r\n')
+            elif command == b'DATA':
+                data = True
+                stream.write(b'354 go ahead\r\n')
+            elif command == b'QUIT':
+                stream.write(b'221 bye\r\n')
+                stream.flush()
+                break
+            else:
+                stream.write(b'250 OK\r\n')
+            stream.flush()
+        client.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        description='Send emails through SMTPTransport to a local SMTP sink '
+                    'and report throughput.')
+    argparser.add_argument('--emails', type=int, default=1000)
+    argparser.add_argument('--threads', type=int, default=4)
+    args, unknown = argparser.parse_known_args()
+
+    sink = SMTPSink()
+    transport = SMTPTransport(port=sink.port, sender='bench@example.com',
+                              pool_size=args.threads)
+    messages = [('me', 'user%d@example.com' % x, 'Bench %d' % x,
+                 '<p>Row %d</p>' % x, '', None) for x in range(args.emails)]
+    chunks = [messages[x:x + transport.batch_size]
+              for x in range(0, len(messages), transport.batch_size)]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not chunks:
+                    return
+                chunk = chunks.pop()
+            transport.send(chunk, {})
+
+    start = time.time()
+    threads = [threading.Thread(target=work) for x in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    transport.shutdown()
+    print('%d emails in %.2fs (%.0f per second) over %d connections' %
+          (sink.received, elapsed, sink.received / elapsed, sink.connections))
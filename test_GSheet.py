@@ -0,0 +1,109 @@
+'''
+Tests of the SheetsClient snapshot cache, run against FakeGoogle.
+
+    python -m unittest test_GSheet
+'''
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import GSheet
+import GDrive
+import Daemon
+import FakeGoogle
+
+URL = 'https://docs.google.com/spreadsheets/d/abc/edit'
+ENTRIES = [(URL, 'Form Responses 1'), (URL, 'Form Responses 2')]
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.backend = FakeGoogle.FakeBackend(rows=50, seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def client(self):
+        '''A client set up the way Engine sets up its own, recording the
+        ranges of every batchGet'''
+        client = GSheet.SheetsClient(
+            incremental=True, backend=self.backend, cache_dir=self.cache_dir,
+            drive=GDrive.DriveClient(backend=self.backend))
+        client.requested = []
+        batchGet = client.batchGet
+
+        def recordingBatchGet(spreadsheetId, ranges):
+            client.requested += ranges
+            return batchGet(spreadsheetId, ranges)
+        client.batchGet = recordingBatchGet
+        return client
+
+    def grow(self, sheetName, rows):
+        with self.backend.lock:
+            self.backend.addRows(('abc', sheetName), rows)
+            self.backend.versions['abc'] += 1
+
+    def test_warm_restart_fetches_only_tails(self):
+        first = self.client()
+        first.batchGetData(ENTRIES)
+        self.assertEqual(first.requested,
+                         ['Form Responses 1', 'Form Responses 2'])
+        self.grow('Form Responses 1', 3)
+
+        restarted = self.client()
+        data = restarted.batchGetData(ENTRIES)
+        self.assertEqual(restarted.requested,
+                         [GSheet.tailRange('Form Responses 1', 51),
+                          GSheet.tailRange('Form Responses 2', 51)])
+        self.assertEqual([len(x) for x in data], [54, 51])
+        self.assertEqual(data[0].rows(),
+                         self.backend.sheets[('abc', 'Form Responses 1')][0])
+
+    def test_warm_restart_of_unchanged_spreadsheet_fetches_nothing(self):
+        self.client().batchGetData(ENTRIES)
+        restarted = self.client()
+        data = restarted.batchGetData(ENTRIES)
+        self.assertEqual(restarted.requested, [])
+        self.assertEqual([len(x) for x in data], [51, 51])
+
+    def test_damaged_cache_is_a_miss(self):
+        self.client().batchGetData(ENTRIES)
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith('.version'):
+                    with open(path, 'r+b') as snapshot:
+                        snapshot.truncate(os.path.getsize(path) // 2)
+        restarted = self.client()
+        data = restarted.batchGetData(ENTRIES)
+        self.assertEqual(restarted.requested,
+                         ['Form Responses 1', 'Form Responses 2'])
+        self.assertEqual([len(x) for x in data], [51, 51])
+
+    def test_daemon_start_uses_the_cache(self):
+        savefile = os.path.join(self.cache_dir, 'save.txt')
+        with open(savefile, 'w') as save:
+            save.write('SaveFile for an Email Formatter\n')
+            for url, title in ENTRIES:
+                save.write('Sheet\n' + url + '\n' + title + '\n')
+        self.client().batchGetData(ENTRIES)
+        self.grow('Form Responses 2', 2)
+
+        # only what start needs, so no outbox or image directory is made
+        daemon = Daemon.Form2EmailDaemon.__new__(Daemon.Form2EmailDaemon)
+        daemon.savefile = savefile
+        daemon.sheets_client = self.client()
+        self.assertTrue(daemon.start())
+        self.assertEqual(daemon.sheets_client.requested,
+                         [GSheet.tailRange('Form Responses 1', 51),
+                          GSheet.tailRange('Form Responses 2', 51)])
+        self.assertEqual([len(x) for x in daemon.sheet_data], [51, 53])
+
+
+if __name__ == '__main__':
+    unittest.main()